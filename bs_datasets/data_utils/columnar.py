@@ -0,0 +1,138 @@
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# "json" writes the dataset.json file, "columnar" the binary arrays described below, "both" writes both formats
+OUTPUT_FORMATS = ['json', 'columnar', 'both']
+
+COLUMNAR_FORMAT_VERSION = 1
+
+# dense values, int32 array (n_intervals, n_nodes, n_features)
+VALUES_FILE = 'values.npy'
+# sparse origin-destination values in COO format, int32 array (n_entries, 4) of
+# (interval index, origin node index, destination node index, value), sorted by interval
+OD_FILE = 'od.npy'
+# row offsets of the od entries of each interval, int64 array (n_intervals + 1):
+# the entries of interval i are od[od_offsets[i]: od_offsets[i + 1]]
+OD_OFFSETS_FILE = 'od_offsets.npy'
+# ids of the nodes, features, start date and step of the intervals
+INDEX_FILE = 'index.json'
+# weather data of each interval, if available
+WEATHER_FILE = 'weather.json'
+
+OD_TMP_FILE = 'od.tmp'
+OD_COPY_BLOCK_SIZE = 1 << 20
+
+SUB_DATASET_FEATURES = ['started_in', 'started_out', 'ended']
+CDRC_DATASET_FEATURES = ['bikes_difference']
+
+
+def check_output_format(output_format: str):
+    if output_format not in OUTPUT_FORMATS:
+        raise AttributeError(f'Output format "{output_format}" not available. Use one of {OUTPUT_FORMATS}')
+
+
+class ColumnarDatasetWriter:
+    """
+    Stream the intervals of a dataset into a directory of .npy files, one row of values per interval and node
+    plus an optional sparse origin-destination tensor.
+    The values array is memory-mapped and filled in place, the od entries are appended to a temporary file
+    and copied in the final array by `close`, so the dataset is never held in memory.
+    Intervals with od entries must be written in chronological order
+    """
+
+    def __init__(
+            self,
+            path: str,
+            node_ids: List[str],
+            features: List[str],
+            start_date: datetime,
+            step: int,
+            n_intervals: int,
+            with_od: bool = False
+    ):
+        # only numpy and the standard library, so the readers of the datasets do not depend on the pipelines
+        os.makedirs(path, exist_ok=True)
+        self.path: str = path
+        self.ids: List[str] = list(dict.fromkeys(node_ids))
+        self.index: Dict[str, int] = {node_id: i for i, node_id in enumerate(self.ids)}
+        self.features: List[str] = features
+        self.start_date: datetime = start_date
+        self.step: int = step
+        self.n_intervals: int = n_intervals
+        self.with_od: bool = with_od
+        self.values: np.ndarray = np.lib.format.open_memmap(
+            os.path.join(self.path, VALUES_FILE), mode='w+', dtype=np.int32,
+            shape=(n_intervals, len(self.ids), len(features)))
+        self._od_counts: np.ndarray = np.zeros(n_intervals, dtype=np.int64)
+        self._od_file = open(os.path.join(self.path, OD_TMP_FILE), 'wb') if with_od else None
+        self._last_od_interval: int = -1
+
+    def write_interval(
+            self,
+            index: int,
+            values: Dict[str, Sequence[int]],
+            od: Optional[Iterable[Tuple[str, str, int]]] = None
+    ):
+        """
+        Set the feature values of the given nodes in the interval and append its (origin, destination, value)
+        entries. Nodes not in `values` keep their previous values (zeros if never set)
+        """
+        if len(values) > 0:
+            columns = np.fromiter((self.index[node_id] for node_id in values.keys()), dtype=np.int64,
+                                  count=len(values))
+            self.values[index, columns] = np.array(list(values.values()), dtype=np.int32).reshape(len(values), -1)
+        if od is None or self._od_file is None:
+            return
+        rows = [(index, self.index[origin], self.index[destination], value) for origin, destination, value in od]
+        if len(rows) == 0:
+            return
+        if index < self._last_od_interval:
+            raise AttributeError(f'Interval {index} written after interval {self._last_od_interval}, '
+                                 f'the od entries must be written in chronological order')
+        self._last_od_interval = index
+        np.array(rows, dtype=np.int32).tofile(self._od_file)
+        self._od_counts[index] += len(rows)
+
+    def close(self, end_date: Optional[datetime] = None, weather: Optional[List[Dict[str, Any]]] = None):
+        self.values.flush()
+        del self.values
+        if self._od_file is not None:
+            self._od_file.close()
+            self._save_od()
+        index = {
+            'format_version': COLUMNAR_FORMAT_VERSION,
+            'ids': self.ids,
+            'features': self.features,
+            'start_date': self.start_date.isoformat(),
+            'end_date': end_date.isoformat() if end_date is not None else None,
+            'step': self.step,
+            'n_intervals': self.n_intervals,
+            'od': self.with_od,
+            'weather': weather is not None,
+        }
+        with open(os.path.join(self.path, INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+        if weather is not None:
+            with open(os.path.join(self.path, WEATHER_FILE), 'w') as f:
+                json.dump(weather, f)
+
+    def _save_od(self):
+        tmp_path = os.path.join(self.path, OD_TMP_FILE)
+        n_entries = int(self._od_counts.sum())
+        od = np.lib.format.open_memmap(os.path.join(self.path, OD_FILE), mode='w+', dtype=np.int32,
+                                       shape=(n_entries, 4))
+        if n_entries > 0:
+            entries = np.memmap(tmp_path, dtype=np.int32, mode='r', shape=(n_entries, 4))
+            for start in range(0, n_entries, OD_COPY_BLOCK_SIZE):
+                od[start: start + OD_COPY_BLOCK_SIZE] = entries[start: start + OD_COPY_BLOCK_SIZE]
+            del entries
+        od.flush()
+        del od
+        os.remove(tmp_path)
+        offsets = np.zeros(self.n_intervals + 1, dtype=np.int64)
+        np.cumsum(self._od_counts, out=offsets[1:])
+        np.save(os.path.join(self.path, OD_OFFSETS_FILE), offsets)
@@ -1,7 +1,7 @@
 import json
 import os
 from dataclasses import dataclass
-from typing import List, Optional, Dict, Union
+from typing import List, Optional, Dict, Union, Tuple, Iterator
 
 import pandas as pd
 import requests
@@ -21,10 +21,7 @@ def load_csv_header(csv_path: str) -> List[str]:
     return df.columns.tolist()
 
 
-def load_csv_rows(csv_path: str, n_rows: Optional[int] = None,
-                  skiprows: Optional[int] = None, names: Optional[List[str]] = None):
-    if names is None:
-        names = load_csv_header(csv_path)
+def _get_csv_columns_types(names: List[str]) -> Tuple[Dict[str, type], List[str]]:
     col_types = {}
     parse_dates = []
     mapping_date_fields = get_providers_mapping_date_fields()
@@ -36,10 +33,32 @@ def load_csv_rows(csv_path: str, n_rows: Optional[int] = None,
             parse_dates.append(n)
         else:
             col_types[n] = str
+    return col_types, parse_dates
+
+
+def load_csv_rows(csv_path: str, n_rows: Optional[int] = None,
+                  skiprows: Optional[int] = None, names: Optional[List[str]] = None):
+    if names is None:
+        names = load_csv_header(csv_path)
+    col_types, parse_dates = _get_csv_columns_types(names)
     return pd.read_csv(csv_path, nrows=n_rows, skiprows=skiprows, header=0,
                        names=names, dtype=col_types, parse_dates=parse_dates)
 
 
+def load_csv_chunks(csv_path: str, n_rows: int, names: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read the csv file in a single pass, yielding DataFrames of at most `n_rows` rows
+    with the same schema returned by `load_csv_rows`
+    """
+    if names is None:
+        names = load_csv_header(csv_path)
+    col_types, parse_dates = _get_csv_columns_types(names)
+    with pd.read_csv(csv_path, chunksize=n_rows, header=0, names=names,
+                     dtype=col_types, parse_dates=parse_dates) as reader:
+        for chunk in reader:
+            yield chunk
+
+
 def load_csv_file(
         csv_path: str,
         n_rows: Optional[int] = 50,
@@ -50,15 +69,14 @@ def load_csv_file(
         if n_rows is None:
             yield pd.read_csv(csv_path)
         else:
-            columns = load_csv_header(csv_path)
-            total_rows = count_file_rows(csv_path) - 1
-            chunks = (total_rows // n_rows) + 1
-            log_info(f'{log_prefix}CSV rows: {total_rows} - Chunks: {chunks}', verbose)
             loaded_rows = 0
-            for i in range(chunks):
-                log_info(f'{log_prefix}Processing chuck {i+1}/{chunks}', verbose)
-                yield load_csv_rows(csv_path, n_rows, loaded_rows, columns)
-                loaded_rows += n_rows
+            chunks = 0
+            for chunk in load_csv_chunks(csv_path, n_rows):
+                loaded_rows += len(chunk)
+                chunks += 1
+                log_info(f'{log_prefix}Processing chuck {chunks} - loaded rows: {loaded_rows}', verbose)
+                yield chunk
+            log_info(f'{log_prefix}CSV rows: {loaded_rows} - Chunks: {chunks}', verbose)
 
     else:
         raise AttributeError(f'csv file path not exists at "{csv_path}"')
@@ -0,0 +1,165 @@
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from bs_datasets.data_utils.columnar import COLUMNAR_FORMAT_VERSION, INDEX_FILE, OD_FILE, OD_OFFSETS_FILE, \
+    VALUES_FILE, WEATHER_FILE
+
+IntervalKey = Union[int, datetime, str]
+
+
+@dataclass
+class DatasetWindow:
+    """
+    Intervals [start_index, end_index) of a dataset restricted to a subset of nodes.
+    `values` has shape (n_intervals, n_nodes, n_features) with the nodes in the order of `ids`,
+    `od` rows are (interval, origin, destination, value) with the interval relative to `start_index`
+    and origin/destination as positions in `ids`
+    """
+    start_index: int
+    end_index: int
+    ids: List[str]
+    values: np.ndarray
+    od: Optional[np.ndarray]
+
+
+class DatasetReader:
+    """
+    Read-only access to a dataset saved with the "columnar" output format.
+    The arrays are opened with mmap_mode="r", so only the pages of the accessed intervals are read and the
+    processes opening the same dataset share them through the page cache instead of holding a copy each.
+    Intervals are addressed by index, by datetime or by ISO date string
+    """
+
+    def __init__(self, path: str):
+        index_path = os.path.join(path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            raise AttributeError(f'Columnar dataset not found in "{path}", save it with --output-format columnar')
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index['format_version'] != COLUMNAR_FORMAT_VERSION:
+            raise AttributeError(f'Columnar dataset version {index["format_version"]} not supported, '
+                                 f'expected version {COLUMNAR_FORMAT_VERSION}')
+        self.path: str = path
+        self.ids: List[str] = index['ids']
+        self.node_index: Dict[str, int] = {node_id: i for i, node_id in enumerate(self.ids)}
+        self.features: List[str] = index['features']
+        self.start_date: datetime = datetime.fromisoformat(index['start_date'])
+        self.end_date: Optional[datetime] = datetime.fromisoformat(index['end_date']) \
+            if index['end_date'] is not None else None
+        self.step: timedelta = timedelta(seconds=index['step'])
+        self.n_intervals: int = index['n_intervals']
+        self.values: np.ndarray = np.load(os.path.join(path, VALUES_FILE), mmap_mode='r')
+        self.od: Optional[np.ndarray] = None
+        self.od_offsets: Optional[np.ndarray] = None
+        if index['od']:
+            self.od = np.load(os.path.join(path, OD_FILE), mmap_mode='r')
+            self.od_offsets = np.load(os.path.join(path, OD_OFFSETS_FILE), mmap_mode='r')
+        self._has_weather: bool = index['weather']
+        self._weather: Optional[List[Dict[str, Any]]] = None
+
+    def __len__(self) -> int:
+        return self.n_intervals
+
+    def __getitem__(self, key: IntervalKey) -> Dict[str, Any]:
+        return self.get_interval(key)
+
+    def get_interval_index(self, key: IntervalKey) -> int:
+        """
+        Index of the interval containing the date (or the index itself). Negative indexes count from the end
+        """
+        date = datetime.fromisoformat(key) if isinstance(key, str) else key
+        if isinstance(date, datetime):
+            index = (date - self.start_date) // self.step
+        else:
+            index = int(key) if key >= 0 else self.n_intervals + int(key)
+        if index < 0 or index >= self.n_intervals:
+            raise IndexError(f'Interval {key} out of the dataset range')
+        return index
+
+    def get_date(self, index: int) -> datetime:
+        return self.start_date + self.get_interval_index(index) * self.step
+
+    def get_node_indexes(self, node_ids: List[str]) -> np.ndarray:
+        return np.array([self.node_index[node_id] for node_id in node_ids], dtype=np.int64)
+
+    def get_values(self, key: IntervalKey) -> np.ndarray:
+        """
+        (n_nodes, n_features) values of the interval, as a read-only view of the memory-mapped array
+        """
+        return self.values[self.get_interval_index(key)]
+
+    def get_od(self, key: IntervalKey) -> Optional[np.ndarray]:
+        """
+        (interval, origin, destination, value) entries of the interval, as a read-only view
+        """
+        if self.od is None:
+            return None
+        index = self.get_interval_index(key)
+        return self.od[self.od_offsets[index]: self.od_offsets[index + 1]]
+
+    def get_weather(self, key: IntervalKey) -> Optional[Dict[str, Any]]:
+        if not self._has_weather:
+            return None
+        if self._weather is None:
+            with open(os.path.join(self.path, WEATHER_FILE), 'r') as f:
+                self._weather = json.load(f)
+        return self._weather[self.get_interval_index(key)]
+
+    def get_interval(self, key: IntervalKey) -> Dict[str, Any]:
+        index = self.get_interval_index(key)
+        return {
+            'index': index,
+            'date': self.get_date(index).isoformat(),
+            'values': self.get_values(index),
+            'od': self.get_od(index),
+            'weather': self.get_weather(index),
+        }
+
+    def _get_window_bounds(self, start: Optional[IntervalKey], end: Optional[IntervalKey]) -> Tuple[int, int]:
+        start_index = self.get_interval_index(start) if start is not None else 0
+        if end is None:
+            return start_index, self.n_intervals
+        if isinstance(end, (datetime, str)):
+            # end dates are exclusive, as the max_date of the datasets
+            end_date = datetime.fromisoformat(end) if isinstance(end, str) else end
+            end_index = -((self.start_date - end_date) // self.step)
+        else:
+            end_index = end if end >= 0 else self.n_intervals + end
+        return start_index, max(start_index, min(end_index, self.n_intervals))
+
+    def get_window(
+            self,
+            start: Optional[IntervalKey] = None,
+            end: Optional[IntervalKey] = None,
+            node_ids: Optional[List[str]] = None
+    ) -> DatasetWindow:
+        """
+        Intervals from `start` (inclusive) to `end` (exclusive) of the given nodes (all if None).
+        Without a node subset the values are a view of the memory-mapped array, otherwise only the window
+        of the selected nodes is copied
+        """
+        start_index, end_index = self._get_window_bounds(start, end)
+        values = self.values[start_index: end_index]
+        od = None
+        if self.od is not None:
+            od = self.od[self.od_offsets[start_index]: self.od_offsets[end_index]]
+        if node_ids is None:
+            if od is not None and start_index > 0:
+                od = od - np.array([start_index, 0, 0, 0], dtype=od.dtype)
+            return DatasetWindow(start_index, end_index, self.ids, values, od)
+
+        node_indexes = self.get_node_indexes(node_ids)
+        values = values[:, node_indexes]
+        if od is not None:
+            positions = np.full(len(self.ids), -1, dtype=np.int64)
+            positions[node_indexes] = np.arange(len(node_indexes))
+            od = od[(positions[od[:, 1]] >= 0) & (positions[od[:, 2]] >= 0)]
+            od = np.stack([
+                od[:, 0] - start_index, positions[od[:, 1]], positions[od[:, 2]], od[:, 3]
+            ], axis=1).astype(self.od.dtype)
+        return DatasetWindow(start_index, end_index, list(node_ids), values, od)
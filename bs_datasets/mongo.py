@@ -1,11 +1,23 @@
 import os
-from typing import Optional, List, Any, Dict
+import threading
+import time
+from typing import Optional, List, Any, Dict, Iterable, Union
 from urllib.parse import quote_plus
 
+import bson
 from bson.objectid import ObjectId
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
 from pymongo.results import InsertOneResult
 
+from bs_datasets.logger import logger
+
+DEFAULT_BULK_BATCH_SIZE = 10000
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+
 
 def get_connection_uri(host, port, password, user, db):
     replica_set = os.getenv('MONGO_REPLICA_SET')
@@ -27,6 +39,124 @@ def get_connection_uri(host, port, password, user, db):
     return url
 
 
+def get_bulk_write_concern() -> Optional[WriteConcern]:
+    """
+    Write concern used for the bulk loads, read from the MONGO_BULK_WRITE_CONCERN env variable
+    (for example "0", "1" or "majority"). If not set, the collection write concern is used
+    """
+    value = os.getenv('MONGO_BULK_WRITE_CONCERN')
+    if value is None or len(value) == 0:
+        return None
+    w: Union[int, str] = int(value) if value.isdigit() else value
+    return WriteConcern(w=w)
+
+
+def _is_transient_error(error: PyMongoError) -> bool:
+    return isinstance(error, ConnectionFailure) or error.has_error_label('RetryableWriteError')
+
+
+class MongoBulkWriter:
+    """
+    Accumulate documents and insert them with unordered insert_many calls, flushing every time the buffer
+    reaches `batch_size` documents or `max_bytes` BSON bytes (if provided).
+    It is thread-safe, so a single writer can be shared by the workers of a stage.
+    Transient errors are retried with the same documents (and _ids): documents already inserted by a failed
+    attempt are reported as duplicate keys and skipped on the retry
+    """
+
+    def __init__(
+            self,
+            collection: Collection,
+            batch_size: int = DEFAULT_BULK_BATCH_SIZE,
+            max_bytes: Optional[int] = None,
+            write_concern: Optional[WriteConcern] = None,
+            retries: int = 3,
+            retry_delay: float = 1.0,
+            log_prefix: str = ''
+    ):
+        if write_concern is None:
+            write_concern = get_bulk_write_concern()
+        self.collection: Collection = collection.with_options(write_concern=write_concern) \
+            if write_concern is not None else collection
+        self.batch_size: int = batch_size
+        self.max_bytes: Optional[int] = max_bytes
+        self.retries: int = retries
+        self.retry_delay: float = retry_delay
+        self.log_prefix: str = log_prefix
+        self.inserted_docs: int = 0
+        self._buffer: List[dict] = []
+        self._buffer_bytes: int = 0
+        self._lock = threading.Lock()
+        self._start_time: float = time.perf_counter()
+
+    def __enter__(self) -> 'MongoBulkWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, document: dict):
+        self.extend([document])
+
+    def extend(self, documents: Iterable[dict]):
+        documents = list(documents)
+        with self._lock:
+            self._buffer += documents
+            if self.max_bytes is not None:
+                self._buffer_bytes += sum(len(bson.encode(doc)) for doc in documents)
+            if len(self._buffer) < self.batch_size and \
+                    (self.max_bytes is None or self._buffer_bytes < self.max_bytes):
+                return
+            to_flush = self._pop_buffer()
+        self._insert(to_flush)
+
+    def flush(self):
+        with self._lock:
+            to_flush = self._pop_buffer()
+        self._insert(to_flush)
+
+    def close(self):
+        self.flush()
+        logger.debug(f'{self.log_prefix}Inserted {self.inserted_docs} docs on {self.collection.full_name} '
+                     f'at {self.docs_per_second():.0f} docs/s')
+
+    def docs_per_second(self) -> float:
+        elapsed = time.perf_counter() - self._start_time
+        return self.inserted_docs / elapsed if elapsed > 0 else 0.0
+
+    def _pop_buffer(self) -> List[dict]:
+        to_flush = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        return to_flush
+
+    def _insert(self, documents: List[dict]):
+        for i in range(0, len(documents), self.batch_size):
+            batch = documents[i: i + self.batch_size]
+            self._insert_batch(batch)
+            with self._lock:
+                self.inserted_docs += len(batch)
+
+    def _insert_batch(self, batch: List[dict]):
+        attempt = 0
+        while True:
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                return
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                if attempt > 0 and all(err['code'] == DUPLICATE_KEY_ERROR_CODE for err in write_errors):
+                    return
+                raise
+            except PyMongoError as e:
+                attempt += 1
+                if not _is_transient_error(e) or attempt > self.retries:
+                    raise
+                logger.warning(f'{self.log_prefix}Transient error while inserting on {self.collection.full_name}, '
+                               f'retry {attempt}/{self.retries}: {e}')
+                time.sleep(self.retry_delay * attempt)
+
+
 class MongoConnector:
 
     def __init__(
@@ -45,19 +175,36 @@ class MongoConnector:
         self.db_name = db if db is not None else os.getenv('MONGO_DB')
         if use_tunnelling:
             mongo_password = os.getenv('MONGO_PASSWORD_TUNNELLING')
-        self.client = MongoClient(
-            get_connection_uri(host=self.host, port=self.port, password=mongo_password,
-                               user=mongo_user, db=self.db_name),
-            serverSelectionTimeoutMS=5000
-        )
-        self.init()
+        self.connection_uri = get_connection_uri(host=self.host, port=self.port, password=mongo_password,
+                                                 user=mongo_user, db=self.db_name)
+        # the client (and its monitor threads) is created on the first access, so importing the package
+        # (e.g. for reading the saved datasets) needs neither the mongo settings nor a running server
+        self._client: Optional[MongoClient] = None
+
+    @property
+    def client(self) -> MongoClient:
+        if self._client is None:
+            self._client = MongoClient(self.connection_uri, serverSelectionTimeoutMS=5000)
+        return self._client
+
+    @client.setter
+    def client(self, client: MongoClient):
+        self._client = client
 
     def init(self):
         info = self.client.server_info()
         return info
 
+    def reconnect(self):
+        """
+        Replace the client with a new one using the same connection settings.
+        MongoClient instances are not fork-safe, so it must be called in every child process
+        """
+        self.client = MongoClient(self.connection_uri, serverSelectionTimeoutMS=5000)
+
     def close(self):
-        self.client.close()
+        if self._client is not None:
+            self._client.close()
 
 
 class MongoWrapper(MongoConnector):
@@ -67,13 +214,15 @@ class MongoWrapper(MongoConnector):
                  password: Optional[str] = None,
                  use_tunnelling: bool = False):
         super(MongoWrapper, self).__init__(host, port, user, db, password, use_tunnelling)
-        if self.db_name is not None:
-            self.db = self.client[self.db_name]
+
+    @property
+    def db(self) -> Database:
+        if self.db_name is None:
+            raise AttributeError('No default db set, use set_db first')
+        return self.client[self.db_name]
 
     def set_db(self, db_name: str):
-        if db_name != self.db_name:
-            self.db_name = db_name
-            self.db = self.client[self.db_name]
+        self.db_name = db_name
 
     def _populate(self, document, populate_field: str, populate_collection: str, sub_populate=None):
         ids = [db_ref.id for db_ref in document[populate_field]]
@@ -142,6 +291,10 @@ class MongoWrapper(MongoConnector):
         kwargs = self._set_db(**kwargs)
         return self.db[collection].insert_many(documents, *args, **kwargs)
 
+    def bulk_writer(self, collection: str, db_name: Optional[str] = None, **kwargs) -> MongoBulkWriter:
+        db = self.client[db_name] if db_name is not None else self.db
+        return MongoBulkWriter(db[collection], **kwargs)
+
     def bulk_update(self, collection, documents, query_param, upsert=False, *args, **kwargs):
         kwargs = self._set_db(**kwargs)
         requests = []
@@ -33,7 +33,10 @@ def all_pipeline(
         parallel: int,
         # aggregation_frequency: str,
         # dataset_path: str,
-        skip: str
+        skip: str,
+        executor: str = 'thread',
+        index_mode: str = 'eager',
+        **kwargs
 ):
     logger.info(f'{LOGGER_PREFIX} | Started')
     skip_commands = skip.split(',') if skip is not None else []
@@ -41,7 +44,8 @@ def all_pipeline(
     execute_or_skip(skip_commands, 'split', split_csv_files_pipeline, provider, split_path, n_rows, download_path)
     execute_or_skip(skip_commands, 'docking', docking_station_pipeline, provider)
     raw_source_path = split_path if provider == 'all' else os.path.join(split_path, provider, 'chunks')
-    execute_or_skip(skip_commands, 'raw', raw_trip_data_pipeline, provider, raw_source_path, parallel)
+    execute_or_skip(skip_commands, 'raw', raw_trip_data_pipeline, provider, raw_source_path, parallel, executor,
+                    index_mode)
     logger.info(f'{LOGGER_PREFIX} | Completed')
 
 
@@ -0,0 +1,122 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from queue import Queue
+from typing import Iterable, Callable, Any, Dict, List, Optional
+
+from bs_datasets import logger
+
+_END_OF_STREAM = object()
+
+
+@dataclass
+class StageCounter:
+    name: str
+    items: int = 0
+    records: int = 0
+    busy_seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, records: int, seconds: float):
+        with self._lock:
+            self.items += 1
+            self.records += records
+            self.busy_seconds += seconds
+
+    def records_per_second(self) -> float:
+        return self.records / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+    def to_log(self) -> str:
+        return f'{self.name}: {self.items} batches - {self.records} records - ' \
+               f'{self.busy_seconds:.2f}s busy - {self.records_per_second():.0f} records/s'
+
+
+def run_bounded_pipeline(
+        source: Iterable[Any],
+        transform: Callable[[Any], Any],
+        write: Callable[[Any], None],
+        transform_workers: int = 1,
+        write_workers: int = 1,
+        max_in_flight: Optional[int] = None,
+        count: Callable[[Any], int] = len,
+        log_prefix: str = ''
+) -> Dict[str, StageCounter]:
+    """
+    Run a reader -> transformer -> writer pipeline. The reader is the calling thread iterating over `source`,
+    transformers and writers are pools of threads connected by bounded queues. When a queue holds
+    `max_in_flight` items the previous stage blocks, so the memory used by the pipeline does not depend
+    on the size of the source.
+    Errors raised by `transform` or `write` are logged and the item is dropped, as done by the pool
+    error callbacks of the other stages.
+    Returns the counters of the read, transform and write stages
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * max(transform_workers, write_workers)
+    counters = {
+        'read': StageCounter('read'),
+        'transform': StageCounter('transform'),
+        'write': StageCounter('write'),
+    }
+    transform_queue: Queue = Queue(maxsize=max_in_flight)
+    write_queue: Queue = Queue(maxsize=max_in_flight)
+
+    def transform_worker():
+        while True:
+            item = transform_queue.get()
+            if item is _END_OF_STREAM:
+                break
+            start = time.perf_counter()
+            try:
+                result = transform(item)
+            except Exception as e:
+                logger.exception(e)
+                continue
+            counters['transform'].add(count(result), time.perf_counter() - start)
+            write_queue.put(result)
+
+    def write_worker():
+        while True:
+            item = write_queue.get()
+            if item is _END_OF_STREAM:
+                break
+            start = time.perf_counter()
+            try:
+                write(item)
+            except Exception as e:
+                logger.exception(e)
+                continue
+            counters['write'].add(count(item), time.perf_counter() - start)
+
+    transformers = _start_threads(transform_worker, transform_workers, 'transformer')
+    writers = _start_threads(write_worker, write_workers, 'writer')
+    try:
+        iterator = iter(source)
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, _END_OF_STREAM)
+            if item is _END_OF_STREAM:
+                break
+            counters['read'].add(count(item), time.perf_counter() - start)
+            transform_queue.put(item)
+    finally:
+        _stop_threads(transformers, transform_queue)
+        _stop_threads(writers, write_queue)
+    for counter in counters.values():
+        logger.info(f'{log_prefix}{counter.to_log()}')
+    return counters
+
+
+def _start_threads(target: Callable[[], None], n_threads: int, name: str) -> List[threading.Thread]:
+    threads = []
+    for i in range(n_threads):
+        thread = threading.Thread(target=target, name=f'{name}-{i}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def _stop_threads(threads: List[threading.Thread], queue: Queue):
+    for _ in threads:
+        queue.put(_END_OF_STREAM)
+    for thread in threads:
+        thread.join()
@@ -23,16 +23,18 @@ def all_pipeline(
         add_weather_data: bool = False,
         weather_db: Optional[str] = None,
         weather_collection: str = 'observations',
+        index_mode: str = 'eager',
+        output_format: str = 'json',
         **kwargs
 ):
     logger.info(f'{LOGGER_PREFIX} | Started')
     skip_commands = skip.split(',') if skip is not None else []
     execute_or_skip(skip_commands, 'docking', docking_station_pipeline, provider)
-    execute_or_skip(skip_commands, 'raw', raw_trip_data_pipeline, provider, year)
+    execute_or_skip(skip_commands, 'raw', raw_trip_data_pipeline, provider, year, index_mode=index_mode)
     execute_or_skip(skip_commands, 'zones', zones_pipeline, provider, -1)
     execute_or_skip(skip_commands, 'subdataset', dataset_pipeline, provider, dataset_path,
                     min_date, max_date, aggregation_unit, aggregation_size, name_suffix, add_weather_data, weather_db,
-                    weather_collection, True)
+                    weather_collection, True, output_format)
     logger.info(f'{LOGGER_PREFIX} | Completed')
 
 
@@ -4,17 +4,25 @@ from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
 
 import pandas as pd
+from pymongo import ASCENDING
+from pymongo.cursor import Cursor
 
 from bs_datasets import logger, mongo_wrapper
+from bs_datasets.data_utils.columnar import ColumnarDatasetWriter, CDRC_DATASET_FEATURES, check_output_format
 from bs_datasets.data_utils.data_loader import load_cdrc_providers_info, load_cdrc_provider_info
 from bs_datasets.filesystem import create_directory
 from bs_datasets.pipelines.cdrc_pipelines.defaults import DB_PREFIX
 from bs_datasets.pipelines.cdrc_pipelines.docking_stations import DockingStation, MIN_CAPACITY
+from bs_datasets.pipelines.distances import DistanceMatrix
+from bs_datasets.pipelines.nodes import get_nodes_zone_index
 from bs_datasets.pipelines.raw_trip_data import raw_trip_data_collection
 from bs_datasets.pipelines.sub_dataset import TIME_UNITS_MAPPING
+from bs_datasets.pipelines.weather_data import get_dates_weather
 
 STAGE_NAME = 'Dataset stage'
 
+DEFAULT_CURSOR_BATCH_SIZE = 10000
+
 
 def dataset_pipeline(
         provider: str,
@@ -28,6 +36,7 @@ def dataset_pipeline(
         weather_db: Optional[str] = None,
         weather_collection: str = 'observations',
         nodes_from_zones: bool = False,
+        output_format: str = 'json',
         **kwargs
 ):
     args = {
@@ -41,6 +50,7 @@ def dataset_pipeline(
         'weather_db': weather_db,
         'weather_collection': weather_collection,
         'nodes_from_zones': nodes_from_zones,
+        'output_format': output_format,
     }
     if provider == 'all':
         providers_info = load_cdrc_providers_info()
@@ -66,7 +76,9 @@ def _single_proivder_dataset(
         weather_db: Optional[str] = None,
         weather_collection: str = 'observations',
         nodes_from_zones: bool = False,
+        output_format: str = 'json',
 ):
+    check_output_format(output_format)
     db_name = f'{DB_PREFIX}-{provider}'
     logger.info(f'{STAGE_NAME} | Started provider {provider}')
     provider_info = load_cdrc_provider_info(provider)
@@ -85,30 +97,51 @@ def _single_proivder_dataset(
     if nodes_from_zones:
         zones = get_zones(zones_path)
     nodes_last_bikes: Dict[str, Optional[int]] = {node: None for node in nodes}
-    previous_interval: Optional[datetime] = None
-
-    for date_interval_str, _ in dataset.items():
-        date_interval = datetime.fromisoformat(date_interval_str)
-        stations = {}
-        if previous_interval is not None:
-            nodes_in_interval = get_record_in_interval(db_name, raw_collection_name, nodes,
-                                                       min_date=previous_interval, max_date=date_interval)
-            for node_data in nodes_in_interval:
-                station_id = node_data['station_id']
-                last_bikes = nodes_last_bikes[station_id]
-                current_bikes = int(node_data['bikes'])
-                if last_bikes is not None:
-                    # verify the difference of bikes in the interval
-                    if last_bikes != current_bikes:
-                        difference = current_bikes - last_bikes
-                        # negative value -> node has fewer bikes than before
-                        # positive value -> node has more bikes than before
-                        stations[station_id] = difference
-                nodes_last_bikes[station_id] = current_bikes
-
-        dataset[date_interval.isoformat()]['stations'] = stations
-        dataset[date_interval.isoformat()]['n_stations'] = len(stations)
-        previous_interval = date_interval
+    intervals = list(dataset.keys())
+    step = timedelta(seconds=aggregation_size * TIME_UNITS_MAPPING[aggregation_unit])
+
+    if name_suffix is None:
+        output = os.path.join(output, f'dataset-s={min_date.isoformat()}-e={max_date.isoformat()}')
+    else:
+        output = os.path.join(output, f'dataset-{name_suffix}')
+    save_json = output_format != 'columnar'
+    writer = None
+    if output_format != 'json':
+        writer = ColumnarDatasetWriter(output, nodes, CDRC_DATASET_FEATURES, min_date, int(step.total_seconds()),
+                                       len(intervals))
+
+    # the records are assigned to the interval closing after them, so the records after the last interval
+    # start are never used
+    records = []
+    if len(intervals) > 1:
+        records = stream_records_in_range(db_name, raw_collection_name, nodes,
+                                          min_date=min_date, max_date=datetime.fromisoformat(intervals[-1]))
+    n_records = 0
+    for node_data in records:
+        n_records += 1
+        interval_index = get_record_interval_index(node_data['timestamp'], min_date, step)
+        stations = dataset[intervals[interval_index]]['stations']
+        station_id = node_data['station_id']
+        last_bikes = nodes_last_bikes[station_id]
+        current_bikes = int(node_data['bikes'])
+        if last_bikes is not None:
+            # verify the difference of bikes in the interval
+            if last_bikes != current_bikes:
+                difference = current_bikes - last_bikes
+                # negative value -> node has fewer bikes than before
+                # positive value -> node has more bikes than before
+                if save_json:
+                    stations[station_id] = difference
+                if writer is not None:
+                    writer.write_interval(interval_index, {station_id: [difference]})
+        nodes_last_bikes[station_id] = current_bikes
+    logger.info(f'{STAGE_NAME} | Provider {provider} streamed {n_records} records over {len(intervals)} intervals')
+    if writer is not None:
+        writer.close(max_date, [val['weather'] for val in dataset.values()] if add_weather_data else None)
+        logger.info(f'{STAGE_NAME} | Saved the columnar dataset of provider {provider} in {writer.path}')
+
+    for date_interval_str in intervals:
+        dataset[date_interval_str]['n_stations'] = len(dataset[date_interval_str]['stations'])
 
     # change index
     final_dataset = {}
@@ -123,14 +156,10 @@ def _single_proivder_dataset(
                                   ),
                                   zones=zones)
 
-    if name_suffix is None:
-        output = os.path.join(output, f'dataset-s={min_date.isoformat()}-e={max_date.isoformat()}')
-    else:
-        output = os.path.join(output, f'dataset-{name_suffix}')
-
     create_directory(output)
-    with open(os.path.join(output, 'dataset.json'), 'w') as f:
-        json.dump(final_dataset, f, indent=2)
+    if save_json:
+        with open(os.path.join(output, 'dataset.json'), 'w') as f:
+            json.dump(final_dataset, f, indent=2)
     with open(os.path.join(output, 'nodes.json'), 'w') as f:
         json.dump(nodes_data, f, indent=2)
     if nodes_from_zones:
@@ -151,40 +180,22 @@ def init_empty_dataset(
     dataset: Dict[str, Dict[str, Any]] = {}
     current_date = min_date
     end_date = max_date
-    index = 0
-    last_weather = None
-    none_counter = 0
-    last_hour = None
+    dates: List[datetime] = []
     while current_date < end_date:
-        weather_data = {}
-        if add_weather_data:
-            # TODO weather is missing now
-            weather_date_str = current_date.strftime('%Y-%m-%d %H')
-            if current_date.hour != last_hour or last_hour is None:
-                fetched = mongo_wrapper.client[weather_db][weather_collection].find_one({'time_str': weather_date_str})
-                if fetched is None:
-                    fetched = last_weather
-                    none_counter += 1
-                else:
-                    none_counter = 0
-            else:
-                fetched = last_weather
-            weather_data['condition'] = fetched['condition']
-            weather_data['temperature'] = fetched['temperature']
-            weather_data['wind_speed'] = fetched['wind_speed']
-            last_weather = fetched
-            last_hour = current_date.hour
-            if none_counter > 2:
-                logger.warn(f'Weather for {weather_date_str} None in the last {none_counter} step')
-        dataset[current_date.isoformat()] = {
+        dates.append(current_date)
+        current_date += timedelta(seconds=aggregation_size)
+    dates_weather: List[Dict[str, Any]] = [{} for _ in dates]
+    if add_weather_data:
+        # TODO weather is missing now
+        dates_weather = get_dates_weather(dates, weather_db, weather_collection)
+    for index, (date, weather_data) in enumerate(zip(dates, dates_weather)):
+        dataset[date.isoformat()] = {
             'index': index,
-            'date': current_date.isoformat(),
+            'date': date.isoformat(),
             'n_stations': 0,
             'weather': weather_data,
             'stations': {}
         }
-        index += 1
-        current_date += timedelta(seconds=aggregation_size)
     return dataset
 
 
@@ -215,32 +226,41 @@ def get_zones_to_save(zones_path: str) -> dict:
     return zones_dict
 
 
-def get_record_in_interval(
+def stream_records_in_range(
         db_name: str,
         collection_name: str,
         nodes: List[str],
         min_date: datetime,
-        max_date: datetime
-):
-    options = {'allowDiskUse': True}
-    pipeline = [
-        {
-            '$sort': {
-                'timestamp': 1
-            }
-        }, {
-            '$match': {
-                'timestamp': {
-                    '$gte': min_date,
-                    '$lte': max_date
-                },
-                'station_id': {
-                    '$in': nodes
-                }
-            }
+        max_date: datetime,
+        batch_size: int = DEFAULT_CURSOR_BATCH_SIZE
+) -> Cursor:
+    """
+    Single cursor over the records of the nodes in [min_date, max_date], sorted by timestamp
+    """
+    return mongo_wrapper.client[db_name][collection_name].find({
+        'timestamp': {
+            '$gte': min_date,
+            '$lte': max_date
+        },
+        'station_id': {
+            '$in': nodes
         }
-    ]
-    return mongo_wrapper.client[db_name][collection_name].aggregate(pipeline, **options)
+    }, {
+        '_id': False,
+        'station_id': True,
+        'timestamp': True,
+        'bikes': True
+    }, batch_size=batch_size, allow_disk_use=True).sort('timestamp', ASCENDING)
+
+
+def get_record_interval_index(timestamp: datetime, min_date: datetime, step: timedelta) -> int:
+    """
+    Index of the interval whose previous boundary is before the record and its own start is after (or equal),
+    i.e. the record is counted in the first interval starting at or after its timestamp.
+    The records on min_date belong to the second interval, the first one is always empty
+    """
+    index = -((min_date - timestamp) // step)
+    return max(index, 1)
 
 
 def build_nodes_file(
@@ -251,18 +271,21 @@ def build_nodes_file(
         zones: Optional[Dict[str, List[str]]] = None
 ) -> dict:
     nodes_data = {}
+    distance_matrix = DistanceMatrix.load(db_name)
     results = mongo_wrapper.client[db_name][collection_name].find({'station_id': {'$in': nodes}}, {
         '_id': False,
-        'station_updated_at': False
+        'station_updated_at': False,
+        'distances_ref': False
     })
     sum_df = pd.read_csv(sum_filepath)
     sum_perc_col = ((sum_df['bikes'] + sum_df['ebikes']) * 100) / sum_df['total_docks']
     mean_capacity_ratio = sum_perc_col.mean() / 100
+    zone_index = get_nodes_zone_index(zones) if zones is not None else None
     for node_data in results:
         node_extra = {'bikes_percentage': mean_capacity_ratio}
-        if zones is not None:
-            node_zone_id = get_node_zone(node_data['station_id'], zones)
-            node_extra['zone_id'] = node_zone_id
+        if zone_index is not None:
+            node_extra['zone_id'] = zone_index.get(node_data['station_id'])
+        node_data['distances'] = distance_matrix.sorted_distances(node_data['station_id'])
         node_data_to_save = {
             **node_extra,
             **{key: value for key, value in node_data.items()}
@@ -274,10 +297,3 @@ def build_nodes_file(
         'nodes': nodes_data
     }
 
-
-def get_node_zone(node_id: str, zones: Dict[str, List[str]]) -> str:
-    for zone_id, zone_nodes in zones.items():
-        for node in zone_nodes:
-            if node == node_id:
-                return zone_id
-
@@ -5,16 +5,19 @@ from typing import Dict, Union, List, Optional
 from uuid import uuid4
 
 import pandas as pd
-from pymongo import ASCENDING, GEOSPHERE
 
 from bs_datasets import mongo_wrapper, logger
 from bs_datasets.data_utils.data_loader import load_cdrc_providers_info, load_cdrc_provider_info
 from bs_datasets.pipelines.cdrc_pipelines.defaults import DB_PREFIX
+from bs_datasets.pipelines.distances import build_distance_matrix
+from bs_datasets.pipelines.indexes import create_collection_indexes
 
 STAGE_NAME = 'Docking station stage'
 
 MIN_CAPACITY = 5
 
+CDRC_DOCKING_INDEXES_KEY = 'cdrc_docking_stations'
+
 
 class DockingStation:
     collection_name = 'docking_stations'
@@ -37,7 +40,6 @@ class DockingStation:
         self.position: Dict[str, Union[str, List[float]]] = {'type': 'Point', 'coordinates': [lon, lat]}
         self.station_updated_at: datetime = datetime.fromisoformat(
             updated_dt) if updated_dt is not None and isinstance(updated_dt, str) else None
-        self.distances: Dict[str, float] = {}
 
     def update_lat(self, lat: float):
         self.lat = lat
@@ -54,40 +56,11 @@ class DockingStation:
             'capacity': self.capacity,
             'position': self.position,
             'station_updated_at': self.station_updated_at,
-            'distances': self.distances
-        }
-
-    def update_distances(self, db_name: str):
-        self.distances = get_station_distances(db_name, self.collection_name, self.position)
-        mongo_wrapper.client[db_name][self.collection_name].update_one(
-            {'station_id': self.station_id}, {'$set': {'distances': self.distances}})
-
-
-def get_station_distances(db_name: str, collection_name: str, point: dict) -> Dict[str, float]:
-    distances: Dict[str, float] = {}
-    result = mongo_wrapper.client[db_name][collection_name].aggregate([
-        {
-            '$geoNear': {
-                'near': point,
-                'distanceField': 'distance',
-                'spherical': True
-            }
-        },
-        {
-            '$sort': {
-                'distance': 1
-            }
         }
-    ])
-    for res in result:
-        distances[res['station_id']] = res['distance']
-    return distances
 
 
 def create_indexes(db_name: str, collection_name: str):
-    mongo_wrapper.client[db_name][collection_name].create_index(
-        [('station_id', ASCENDING)], background=True, unique=True)
-    mongo_wrapper.client[db_name][collection_name].create_index([('position', GEOSPHERE)], background=True)
+    create_collection_indexes(db_name, collection_name, CDRC_DOCKING_INDEXES_KEY)
 
 
 def docking_station_pipeline(provider: str):
@@ -105,7 +78,8 @@ def docking_station_pipeline(provider: str):
 
 
 def flush_on_db(db_name: str, collection_name: str, documents: List[dict]) -> List:
-    mongo_wrapper.client[db_name][collection_name].insert_many(documents)
+    with mongo_wrapper.bulk_writer(collection_name, db_name, log_prefix=f'{STAGE_NAME} | ') as writer:
+        writer.extend(documents)
     return []
 
 
@@ -145,19 +119,8 @@ def _docking_station_pipeline(provider: str):
             logger.debug(f'{STAGE_NAME} | Processing docking stations processing line {i}/{n_stations}')
         i += 1
     flush_on_db(db_name, DockingStation.collection_name, [doc for _, doc in documents.items() if doc is not None])
-    logger.info(f'{STAGE_NAME} | Updating docking station distances')
-    i = 0
-    for index, row in df.iterrows():
-        d_station = DockingStation(**row.to_dict())
-        if d_station.capacity > MIN_CAPACITY and not skip_docking_entry(d_station):
-            try:
-                d_station.update_distances(db_name)
-            except Exception as e:
-                logger.error(f'Unable to update distances for docking station {d_station.to_dict()}')
-                logger.exception(e)
-        if i % (n_stations // 4) == 0:
-            logger.debug(f'{STAGE_NAME} | Updated {i}/{n_stations} docking stations distances')
-        i += 1
+    logger.info(f'{STAGE_NAME} | Building docking station distance matrix')
+    build_distance_matrix(db_name, DockingStation.collection_name, 'station_id', log_prefix=f'{STAGE_NAME} | ')
     logger.info(f'{STAGE_NAME} | Completed provider {provider}')
 
 
@@ -1,21 +1,22 @@
 import json
 import os
 from multiprocessing.pool import ThreadPool
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import haversine
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from haversine import Unit
 from pandas import DataFrame
 from shapely import Point, Polygon
-from sklearn.cluster import KMeans
 
 from bs_datasets import mongo_wrapper, logger
 from bs_datasets.data_utils.data_loader import load_cdrc_providers_info, load_cdrc_provider_info
 from bs_datasets.filesystem import create_directory
 from bs_datasets.pipelines.cdrc_pipelines.defaults import DB_PREFIX
 from bs_datasets.pipelines.cdrc_pipelines.docking_stations import MIN_CAPACITY
+from bs_datasets.pipelines.clustering import benchmark_clustering, cluster_features, load_zones_centroids
 
 STAGE_NAME = 'Zones extraction stage'
 
@@ -25,8 +26,13 @@ def zones_pipeline(
         n_zones: int,
         docking_station_collection_name: str = 'docking_stations',
         show_zones: bool = False,
+        clustering_backend: str = 'legacy',
+        clustering_jobs: Optional[int] = None,
+        warm_start: bool = False,
+        clustering_benchmark: bool = False,
         **kwargs,
 ):
+    clustering_args = (clustering_backend, clustering_jobs, warm_start, clustering_benchmark)
     if provider == 'all':
         providers_info = load_cdrc_providers_info()
         logger.info(f'{STAGE_NAME} | Starting for all {len(providers_info)} providers')
@@ -34,13 +40,13 @@ def zones_pipeline(
         for p, _ in providers_info.items():
             pool.apply_async(_zones_pipeline,
                              args=(n_zones, p, docking_station_collection_name,
-                                   show_zones),
+                                   show_zones, *clustering_args),
                              error_callback=lambda e: logger.exception(e))
         pool.close()
         pool.join()
         logger.info(f'{STAGE_NAME} | Completed all {len(providers_info)} providers')
     else:
-        _zones_pipeline(n_zones, provider, docking_station_collection_name, show_zones)
+        _zones_pipeline(n_zones, provider, docking_station_collection_name, show_zones, *clustering_args)
 
 
 def _zones_pipeline(
@@ -48,6 +54,10 @@ def _zones_pipeline(
         provider: str,
         docking_station_collection_name: str = 'docking_stations',
         show_zones: bool = False,
+        clustering_backend: str = 'legacy',
+        clustering_jobs: Optional[int] = None,
+        warm_start: bool = False,
+        clustering_benchmark: bool = False,
         **kwargs,
 ):
     logger.info(f'{STAGE_NAME} | Started provider {provider}')
@@ -58,8 +68,14 @@ def _zones_pipeline(
     recursion_threshold = provider_info['recursion_threshold']
     db_name = f'{DB_PREFIX}-{provider}'
     docks_df = load_data_structures(db_name, docking_station_collection_name)
-
-    zones, zones_centroid = _get_zones(docks_df, n_zones)
+    init_centroids = load_zones_centroids(os.path.join(output, 'zones.json')) if warm_start else None
+    if clustering_benchmark:
+        benchmark_clustering(docks_df[['lng', 'lat']].to_numpy(), n_zones, n_jobs=clustering_jobs,
+                             init_centroids=init_centroids)
+        return
+
+    zones, zones_centroid = _get_zones(docks_df, n_zones, clustering_backend=clustering_backend,
+                                       clustering_jobs=clustering_jobs, init_centroids=init_centroids)
     if recursive:
         nodes_to_exclude = []
         excluded_zones_arr = []
@@ -77,7 +93,11 @@ def _zones_pipeline(
         new_zones, new_zones_centroid = _get_zones(
             docks_df[~docks_df['station_id'].isin(nodes_to_exclude)].reset_index(drop=True),
             n_zones,
-            len(excluded_zones)
+            len(excluded_zones),
+            clustering_backend=clustering_backend,
+            clustering_jobs=clustering_jobs,
+            # the previous zones also include the excluded ones, use only the last n_zones centroids
+            init_centroids=init_centroids[-n_zones:] if init_centroids is not None else None
         )
         zones = excluded_zones
         zones_centroid = excluded_centroid
@@ -94,23 +114,25 @@ def _zones_pipeline(
     logger.info(f'{STAGE_NAME} | Completed provider {provider}')
 
 
-def _get_zones(docks_df: pd.DataFrame, n_zones: int, zone_index_start: int = 0):
+def _get_zones(
+        docks_df: pd.DataFrame,
+        n_zones: int,
+        zone_index_start: int = 0,
+        clustering_backend: str = 'legacy',
+        clustering_jobs: Optional[int] = None,
+        init_centroids: Optional[np.ndarray] = None
+):
     nodes_coords_to_station_id = {}
     for _, row in docks_df.iterrows():
         nodes_coords_to_station_id[(row['lng'], row['lat'])] = row['station_id']
     nodes_features = docks_df[['lng', 'lat']].to_numpy()
-    km = KMeans(
-        n_clusters=n_zones, init='random',
-        n_init=100, max_iter=30000,
-        tol=1e-18, random_state=0
-    )
-    y_km = km.fit_predict(nodes_features)
-    u_labels = km.labels_
+    y_km = cluster_features(nodes_features, n_zones, clustering_backend, clustering_jobs, init_centroids)
 
     zones = {}
     zones_centroid = {}
 
-    for i in u_labels:
+    # zones in order of first appearance of their label
+    for i in dict.fromkeys(y_km.tolist()):
         cluster_nodes_coordinates = nodes_features[y_km == i, :]
         zones[str(i + zone_index_start)] = []
         zones_centroid[str(i + zone_index_start)] = Point(
@@ -0,0 +1,119 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import adjusted_rand_score
+
+from bs_datasets import logger
+
+STAGE_NAME = 'Clustering'
+
+# "legacy": random init, 100 runs and no early stop (the original zones settings)
+# "kmeans++": k-means++ seeding, 10 runs and early stop on the default tolerance
+# "minibatch": MiniBatchKMeans with early stop when the inertia does not improve
+CLUSTERING_BACKENDS = ['legacy', 'kmeans++', 'minibatch']
+
+RANDOM_STATE = 0
+
+
+def _get_kmeans_params(backend: str) -> Dict[str, Any]:
+    if backend == 'legacy':
+        return {'init': 'random', 'n_init': 100, 'max_iter': 30000, 'tol': 1e-18}
+    elif backend == 'kmeans++':
+        return {'init': 'k-means++', 'n_init': 10, 'max_iter': 300, 'tol': 1e-4}
+    else:
+        raise AttributeError(f'Clustering backend "{backend}" not available. Use one of {CLUSTERING_BACKENDS}')
+
+
+def _fit_single_init(features: np.ndarray, n_clusters: int, params: Dict[str, Any], seed: int) -> KMeans:
+    return KMeans(n_clusters=n_clusters, **{**params, 'n_init': 1}, random_state=seed).fit(features)
+
+
+def cluster_features(
+        features: np.ndarray,
+        n_clusters: int,
+        backend: str = 'legacy',
+        n_jobs: Optional[int] = None,
+        init_centroids: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Cluster the features and return the label of each row.
+    - `n_jobs` > 1 runs the n_init initializations of the kmeans backends in parallel and keeps the best one
+    - `init_centroids` (one row per cluster) warm-starts a single kmeans run from the given centroids
+    """
+    if init_centroids is not None:
+        if len(init_centroids) == n_clusters:
+            km = KMeans(n_clusters=n_clusters, init=init_centroids, n_init=1, max_iter=300, tol=1e-4)
+            return km.fit_predict(features)
+        logger.info(f'{STAGE_NAME} | Warm start skipped: {len(init_centroids)} centroids for {n_clusters} clusters')
+    if backend == 'minibatch':
+        km = MiniBatchKMeans(n_clusters=n_clusters, batch_size=1024, n_init=10, max_no_improvement=10,
+                             random_state=RANDOM_STATE)
+        return km.fit_predict(features)
+    params = _get_kmeans_params(backend)
+    if n_jobs is None or n_jobs == 1:
+        return KMeans(n_clusters=n_clusters, **params, random_state=RANDOM_STATE).fit_predict(features)
+    seeds = np.random.RandomState(RANDOM_STATE).randint(np.iinfo(np.int32).max, size=params['n_init'])
+    # threads are enough, the kmeans iterations release the GIL
+    runs = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_fit_single_init)(features, n_clusters, params, int(seed)) for seed in seeds)
+    return min(runs, key=lambda run: run.inertia_).labels_
+
+
+def load_zones_centroids(zones_path: str) -> Optional[np.ndarray]:
+    """
+    Centroids ([lng, lat]) of a previous zones.json, None if the file does not exist
+    """
+    if not os.path.exists(zones_path):
+        return None
+    with open(zones_path, 'r') as f:
+        zones = json.load(f)
+    return np.array([zone['centroid'] for zone in zones['zones']], dtype=np.float64)
+
+
+def get_inertia(features: np.ndarray, labels: np.ndarray) -> float:
+    inertia = 0.0
+    for label in np.unique(labels):
+        cluster = features[labels == label]
+        inertia += float(((cluster - cluster.mean(axis=0)) ** 2).sum())
+    return inertia
+
+
+def benchmark_clustering(
+        features: np.ndarray,
+        n_clusters: int,
+        backends: Optional[List[str]] = None,
+        n_jobs: Optional[int] = None,
+        init_centroids: Optional[np.ndarray] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Run every backend (and the warm start, if centroids are given) on the features and log, for each one,
+    the runtime, the inertia and the adjusted rand index of its assignment against the legacy one
+    """
+    if backends is None:
+        backends = CLUSTERING_BACKENDS
+    runs = [(backend, n_jobs if backend != 'minibatch' else None, None) for backend in backends]
+    if init_centroids is not None:
+        runs.append(('warm-start', None, init_centroids))
+    reference = None
+    results = []
+    for name, jobs, centroids in runs:
+        start = time.perf_counter()
+        labels = cluster_features(features, n_clusters, name if centroids is None else 'legacy', jobs, centroids)
+        runtime = time.perf_counter() - start
+        if reference is None:
+            reference = labels
+        results.append({
+            'backend': name,
+            'n_jobs': jobs,
+            'runtime': runtime,
+            'inertia': get_inertia(features, labels),
+            'ari': adjusted_rand_score(reference, labels),
+        })
+        logger.info(f'{STAGE_NAME} | {name:<10} n_jobs={jobs} runtime={runtime:.3f}s '
+                    f'inertia={results[-1]["inertia"]:.6e} ARI vs {results[0]["backend"]}={results[-1]["ari"]:.4f}')
+    return results
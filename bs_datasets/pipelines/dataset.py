@@ -5,7 +5,9 @@ from typing import Dict, Any, List
 from bs_datasets import logger, mongo_wrapper
 from bs_datasets.data_utils.data_loader import get_all_providers_info
 from bs_datasets.filesystem import create_directory_from_filepath, create_directory
+from bs_datasets.pipelines.distances import DistanceMatrix
 from bs_datasets.pipelines.docking_stations import DockingStation
+from bs_datasets.pipelines.nodes import build_nodes_data
 from bs_datasets.pipelines.trip_data import trip_data_collection
 
 
@@ -125,7 +127,7 @@ def create_dataset_from_trip_data(provider: str, output: str, year: str,):
             '$project': {
                 '_id': 0,
                 'position': 0,
-                'distances': 0,
+                'distances_ref': 0,
                 'initial_bikes': 0,
                 'station_doc': 0
             }
@@ -237,7 +239,7 @@ def get_unique_stations(dataset_docs: dict, provider: str) -> List[Dict[str, Any
         {'trip_id': {'$in': list(station_ids.keys())}},
         projection={
             '_id': False,
-            'distances': False,
+            'distances_ref': False,
             'initial_bikes': False
         }
     ))
@@ -276,8 +278,8 @@ def multiple_subdatasets(pivot: str, n: str, source: str, output: str, provider:
 def filter_nodes_from_dataset(pivot: str, n: int, source: str, output: str, provider: str):
     logger.info(f'{STAGE_NAME} | Dataset splitting for {n} nodes starting from {pivot}')
     db_name = f'{mongo_wrapper.db_prefix_name}-{provider}'
-    pivot_station = mongo_wrapper.client[db_name][DockingStation.collection_name].find_one({'trip_id': pivot})
-    nodes_ids: List[str] = [n for n in list(pivot_station['distances'].keys())[: n]]
+    distance_matrix = DistanceMatrix.load(db_name)
+    nodes_ids: List[str] = distance_matrix.nearest_ids(pivot, n)
     with open(source, 'r') as f:
         dataset = json.load(f)
 
@@ -303,31 +305,7 @@ def filter_nodes_from_dataset(pivot: str, n: int, source: str, output: str, prov
         json.dump(new_dataset, f, indent=2)
 
     # build nodes data
-    nodes_data = {}
-    for node_id in nodes_ids:
-        node_data = mongo_wrapper.client[db_name][DockingStation.collection_name].find_one(
-            {'trip_id': node_id},
-            projection={'_id': False}
-        )
-        distances = {}
-        for n_id, distance in node_data['distances'].items():
-            if n_id in nodes_ids:
-                distances[n_id] = distance
-        node_data['distances'] = distances
-        mean_percentages = []
-        for _, info in node_data['initial_bikes'].items():
-            total = info['total_docks']
-            bikes = info['total_bikes']
-            mean_percentages.append((bikes * 100)/total)
-
-        node_data['bikes_percentage'] = (sum(mean_percentages) / len(mean_percentages)) / 100
-        del node_data['initial_bikes']
-        nodes_data[node_id] = node_data
-
-    nodes_data = {
-        'ids': nodes_ids,
-        'nodes': nodes_data
-    }
+    nodes_data = build_nodes_data(db_name, nodes_ids)
     with open(os.path.join(output, 'nodes.json'), 'w') as f:
         json.dump(nodes_data, f, indent=2)
     logger.info(f'{STAGE_NAME} | Dataset split completed and saved in {output}')
@@ -0,0 +1,126 @@
+import json
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from pymongo import UpdateOne
+
+from bs_datasets import logger, mongo_wrapper
+from bs_datasets.filesystem import create_directory
+
+# earth radius used by mongoDb for the spherical distances of $geoNear, so the values match the previous ones
+EARTH_RADIUS_METERS = 6378100
+
+# number of rows of the distance matrix computed and written at a time
+DEFAULT_DISTANCES_CHUNK_SIZE = 256
+
+DISTANCES_BASE_PATH = 'data/distances'
+DISTANCES_MATRIX_FILE = 'distances.npy'
+DISTANCES_IDS_FILE = 'ids.json'
+
+
+def haversine_distances(
+        lon: np.ndarray,
+        lat: np.ndarray,
+        chunk_size: int = DEFAULT_DISTANCES_CHUNK_SIZE
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Pairwise haversine distances in meters between the points, in degrees.
+    The matrix is yielded in blocks of `chunk_size` rows as (first row index, block) pairs to bound the memory
+    """
+    lon_rad = np.radians(np.asarray(lon, dtype=np.float64))
+    lat_rad = np.radians(np.asarray(lat, dtype=np.float64))
+    cos_lat = np.cos(lat_rad)
+    for start in range(0, len(lon_rad), chunk_size):
+        end = min(start + chunk_size, len(lon_rad))
+        d_lat = lat_rad[np.newaxis, :] - lat_rad[start:end, np.newaxis]
+        d_lon = lon_rad[np.newaxis, :] - lon_rad[start:end, np.newaxis]
+        a = np.sin(d_lat / 2) ** 2 + cos_lat[start:end, np.newaxis] * cos_lat[np.newaxis, :] * np.sin(d_lon / 2) ** 2
+        yield start, 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class DistanceMatrix:
+    """
+    Distances in meters between the docking stations of a provider, stored once per db as a float32 matrix
+    (`distances.npy`) plus the ids of its rows and columns (`ids.json`).
+    The matrix is memory-mapped when loaded, so slicing a few nodes does not read the whole file
+    """
+
+    def __init__(self, ids: List[str], matrix: np.ndarray, path: Optional[str] = None):
+        self.ids: List[str] = ids
+        self.matrix: np.ndarray = matrix
+        self.path: Optional[str] = path
+        self.index: Dict[str, int] = {node_id: i for i, node_id in enumerate(ids)}
+
+    @staticmethod
+    def get_path(db_name: str, base_path: str = DISTANCES_BASE_PATH) -> str:
+        return os.path.join(base_path, db_name)
+
+    @classmethod
+    def load(cls, db_name: str, base_path: str = DISTANCES_BASE_PATH, mmap: bool = True) -> 'DistanceMatrix':
+        path = cls.get_path(db_name, base_path)
+        if not os.path.exists(os.path.join(path, DISTANCES_MATRIX_FILE)):
+            raise AttributeError(f'Distance matrix not found in "{path}", run the docking stage first')
+        with open(os.path.join(path, DISTANCES_IDS_FILE), 'r') as f:
+            ids = json.load(f)
+        matrix = np.load(os.path.join(path, DISTANCES_MATRIX_FILE), mmap_mode='r' if mmap else None)
+        return cls(ids, matrix, path)
+
+    def indexes(self, ids: List[str]) -> np.ndarray:
+        return np.array([self.index[node_id] for node_id in ids], dtype=np.int64)
+
+    def submatrix(self, ids: List[str]) -> np.ndarray:
+        indexes = self.indexes(ids)
+        return np.asarray(self.matrix[np.ix_(indexes, indexes)])
+
+    def nearest_ids(self, node_id: str, n: Optional[int] = None) -> List[str]:
+        """
+        Ids sorted by ascending distance from the node (the node itself first), limited to the n nearest
+        """
+        order = np.argsort(self.matrix[self.index[node_id]], kind='stable')
+        return [self.ids[i] for i in order[:n].tolist()]
+
+    def sorted_distances(self, node_id: str, ids: Optional[List[str]] = None) -> Dict[str, float]:
+        """
+        {id: distance} map from the node to the given ids (all if None), sorted by ascending distance
+        """
+        indexes = np.arange(len(self.ids)) if ids is None else np.sort(self.indexes(ids))
+        row = np.asarray(self.matrix[self.index[node_id], indexes])
+        order = np.argsort(row, kind='stable')
+        return dict(zip([self.ids[i] for i in indexes[order].tolist()], row[order].tolist()))
+
+
+def build_distance_matrix(
+        db_name: str,
+        collection_name: str,
+        id_field: str,
+        chunk_size: int = DEFAULT_DISTANCES_CHUNK_SIZE,
+        base_path: str = DISTANCES_BASE_PATH,
+        log_prefix: str = ''
+) -> DistanceMatrix:
+    """
+    Compute the distances between all the documents of the collection from their "position" field and save
+    them as the provider distance matrix. Each document gets a "distances_ref" field with the matrix
+    path and its row, set with a single unordered bulk_write
+    """
+    collection = mongo_wrapper.client[db_name][collection_name]
+    documents = list(collection.find({}, {'_id': False, id_field: True, 'position': True}))
+    ids = [doc[id_field] for doc in documents]
+    coordinates = np.array([doc['position']['coordinates'] for doc in documents], dtype=np.float64).reshape(-1, 2)
+    path = create_directory(DistanceMatrix.get_path(db_name, base_path))
+    matrix = np.lib.format.open_memmap(os.path.join(path, DISTANCES_MATRIX_FILE), mode='w+',
+                                       dtype=np.float32, shape=(len(ids), len(ids)))
+    for start, block in haversine_distances(coordinates[:, 0], coordinates[:, 1], chunk_size):
+        matrix[start: start + len(block)] = block
+    matrix.flush()
+    with open(os.path.join(path, DISTANCES_IDS_FILE), 'w') as f:
+        json.dump(ids, f)
+    if len(ids) > 0:
+        collection.bulk_write([
+            UpdateOne({id_field: doc_id}, {
+                '$set': {'distances_ref': {'path': path, 'row': row}},
+                '$unset': {'distances': ''}
+            }) for row, doc_id in enumerate(ids)
+        ], ordered=False)
+    logger.info(f'{log_prefix}Saved the {len(ids)}x{len(ids)} distance matrix of {db_name} in {path}')
+    return DistanceMatrix(ids, matrix, path)
@@ -2,11 +2,11 @@ import json
 from multiprocessing.pool import ThreadPool
 from typing import Dict, List, Union, Optional
 
-from pymongo import GEO2D, GEOSPHERE, ASCENDING
-
 from bs_datasets import logger, mongo_wrapper
 from bs_datasets.data_utils.data_loader import load_station_information, load_provider_stats, DATASETS_MAPPING_PATH, \
     get_provider_info
+from bs_datasets.pipelines.distances import build_distance_matrix
+from bs_datasets.pipelines.indexes import create_collection_indexes
 
 
 STAGE_NAME = 'Docking station stage'
@@ -39,7 +39,6 @@ class DockingStation:
         self.legacy_id: str = legacy_id
         self.external_id: str = external_id
         self.initial_bikes: Dict[str, Dict[str, int]] = {}
-        self.distances: Dict[str, float] = {}
 
     def to_dict(self) -> dict:
         return {
@@ -53,7 +52,6 @@ class DockingStation:
             'legacy_id': self.legacy_id,
             'external_id': self.external_id,
             'initial_bikes': self.initial_bikes,
-            'distances': self.distances
         }
 
     def set_initial_bikes(self, provider_stats: Dict[str, Dict[str, int]]):
@@ -70,36 +68,15 @@ class DockingStation:
                 'total_stations': total_stations,
             }
 
-    def update_distances(self, db_name: str):
-        self.distances = get_station_distances(db_name, self.collection_name, self.position)
-        mongo_wrapper.client[db_name][self.collection_name].update_one(
-            {'trip_id': self.trip_id}, {'$set': {'distances': self.distances}})
-
 
 def flush_on_db(db_name: str, collection_name: str, documents: List[dict]) -> List:
-    mongo_wrapper.client[db_name][collection_name].insert_many(documents)
+    with mongo_wrapper.bulk_writer(collection_name, db_name, log_prefix=f'{STAGE_NAME} | ') as writer:
+        writer.extend(documents)
     return []
 
 
 def create_indexes(db_name: str, collection_name: str):
-    mongo_wrapper.client[db_name][collection_name].create_index([('trip_id', ASCENDING)], background=True, unique=True)
-    mongo_wrapper.client[db_name][collection_name].create_index([('position', GEOSPHERE)], background=True)
-
-
-def get_station_distances(db_name: str, collection_name: str, point: dict) -> Dict[str, float]:
-    distances: Dict[str, float] = {}
-    result = mongo_wrapper.client[db_name][collection_name].aggregate([
-        {
-            '$geoNear': {
-                'near': point,
-                'distanceField': 'distance',
-                'spherical': True
-            }
-        }
-    ])
-    for res in result:
-        distances[res['trip_id']] = res['distance']
-    return distances
+    create_collection_indexes(db_name, collection_name, DockingStation.collection_name)
 
 
 def docking_station_pipeline(provider: str):
@@ -135,10 +112,6 @@ def _docking_station_pipeline(provider: str):
         if len(documents) > 1000:
             documents = flush_on_db(db_name, DockingStation.collection_name, documents)
     documents = flush_on_db(db_name, DockingStation.collection_name, documents)
-    logger.info(f'{STAGE_NAME} | Updating docking station distances')
-    for i, station in enumerate(docking_stations):
-        d_station = DockingStation(**station)
-        d_station.update_distances(db_name)
-        if i % (n_stations // 4) == 0:
-            logger.debug(f'{STAGE_NAME} | Updated {i}/{n_stations} docking stations distances')
+    logger.info(f'{STAGE_NAME} | Building docking station distance matrix')
+    build_distance_matrix(db_name, DockingStation.collection_name, 'trip_id', log_prefix=f'{STAGE_NAME} | ')
     logger.info(f'{STAGE_NAME} | Completed provider {provider}')
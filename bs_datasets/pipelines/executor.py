@@ -0,0 +1,27 @@
+from multiprocessing.pool import ThreadPool, Pool
+from typing import Optional
+
+from bs_datasets import mongo_wrapper
+
+EXECUTORS = ['thread', 'process']
+
+
+def _init_process_worker(db_prefix_name: Optional[str]):
+    # the client inherited from the parent process is not fork-safe, every worker opens its own
+    mongo_wrapper.reconnect()
+    mongo_wrapper.db_prefix_name = db_prefix_name
+
+
+def get_worker_pool(executor: str, processes: int) -> Pool:
+    """
+    Create the pool used for the chunk stages. The "thread" executor shares the module-level mongo_wrapper,
+    while the "process" executor is meant for CPU-bound stages and gives each worker its own Mongo client.
+    With the "process" executor only picklable arguments (e.g. chunk paths) should be submitted to the pool
+    """
+    if executor == 'thread':
+        return ThreadPool(processes=processes)
+    elif executor == 'process':
+        return Pool(processes=processes, initializer=_init_process_worker,
+                    initargs=(getattr(mongo_wrapper, 'db_prefix_name', None), ))
+    else:
+        raise AttributeError(f'Executor "{executor}" not available. Use one of {EXECUTORS}')
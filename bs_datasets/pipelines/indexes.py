@@ -0,0 +1,152 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+
+from bs_datasets import logger, mongo_wrapper
+
+STAGE_NAME = 'Indexes'
+
+INDEX_MODES = ['eager', 'deferred']
+
+# index specs of the collections created by the pipelines. Keys are the collection names, collections with
+# a dynamic name (e.g. "trip_data-<year>") or shared names across datasets (cdrc) use an explicit registry key
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    'raw_trip_data': [
+        IndexModel([
+            ('start_time', ASCENDING),
+            ('stop_time', ASCENDING),
+            ('start_trip_id', ASCENDING),
+            ('stop_trip_id', ASCENDING),
+            ('duration', ASCENDING)
+        ], background=True),
+        # date range + nodes match of the sub dataset stage
+        IndexModel([
+            ('start_time', ASCENDING),
+            ('start_trip_id', ASCENDING)
+        ], background=True),
+    ],
+    'trip_data': [
+        IndexModel([
+            ('date', ASCENDING),
+            ('operation', ASCENDING),
+            ('station', ASCENDING),
+            ('weekday', ASCENDING),
+            ('value', ASCENDING)
+        ], background=True),
+    ],
+    'docking_stations': [
+        IndexModel([('trip_id', ASCENDING)], background=True, unique=True),
+        IndexModel([('position', GEOSPHERE)], background=True),
+    ],
+    'cdrc_raw_trip_data': [
+        IndexModel([
+            ('station_id', ASCENDING),
+            ('timestamp', ASCENDING),
+            ('capacity', ASCENDING),
+            ('bikes', ASCENDING),
+            ('ebikes', ASCENDING),
+            ('empty_slots', ASCENDING)
+        ], background=True),
+        # sorted scan of the dataset stage
+        IndexModel([('timestamp', ASCENDING)], background=True),
+    ],
+    'weather_observations': [
+        # fields of the "fieldsMapping" of data/weather_api.json
+        IndexModel([
+            ('station_id', ASCENDING),
+            ('station_name', ASCENDING),
+            ('temperature', ASCENDING),
+            ('wind_speed', ASCENDING),
+            ('condition', ASCENDING),
+            ('time', ASCENDING)
+        ], background=True),
+        IndexModel([('time_str', ASCENDING)], background=True),
+    ],
+    'cdrc_docking_stations': [
+        IndexModel([('station_id', ASCENDING)], background=True, unique=True),
+        IndexModel([('position', GEOSPHERE)], background=True),
+    ],
+}
+
+
+def _get_registry_indexes(collection_name: str, registry_key: Optional[str] = None) -> List[IndexModel]:
+    key = registry_key if registry_key is not None else collection_name
+    if key not in INDEX_REGISTRY:
+        raise AttributeError(f'No indexes registered for "{key}". Available: {list(INDEX_REGISTRY.keys())}')
+    return INDEX_REGISTRY[key]
+
+
+def create_collection_indexes(db_name: str, collection_name: str, registry_key: Optional[str] = None) -> float:
+    """
+    Create all the registered indexes of the collection and return the build time in seconds
+    """
+    indexes = _get_registry_indexes(collection_name, registry_key)
+    start = time.perf_counter()
+    mongo_wrapper.client[db_name][collection_name].create_indexes(indexes)
+    build_time = time.perf_counter() - start
+    logger.info(f'{STAGE_NAME} | Built {len(indexes)} indexes on {db_name}.{collection_name} in {build_time:.2f}s')
+    return build_time
+
+
+def drop_secondary_indexes(db_name: str, collection_name: str, registry_key: Optional[str] = None):
+    """
+    Drop the registered non-unique indexes of the collection, unique indexes are kept since they enforce
+    the data integrity during the load
+    """
+    collection = mongo_wrapper.client[db_name][collection_name]
+    existing = collection.index_information()
+    for index in _get_registry_indexes(collection_name, registry_key):
+        name = index.document['name']
+        if not index.document.get('unique', False) and name in existing:
+            collection.drop_index(name)
+            logger.debug(f'{STAGE_NAME} | Dropped index {name} on {db_name}.{collection_name}')
+
+
+@contextmanager
+def managed_indexes(db_name: str, collection_name: str, registry_key: Optional[str] = None, mode: str = 'eager'):
+    """
+    Handle the registered indexes of a collection around a bulk load:
+    - "eager": the indexes are created once before the load
+    - "deferred": the secondary indexes are dropped before the load and built once at the end
+    """
+    if mode == 'eager':
+        create_collection_indexes(db_name, collection_name, registry_key)
+        yield
+    elif mode == 'deferred':
+        drop_secondary_indexes(db_name, collection_name, registry_key)
+        try:
+            yield
+        finally:
+            create_collection_indexes(db_name, collection_name, registry_key)
+    else:
+        raise AttributeError(f'Index mode "{mode}" not available. Use one of {INDEX_MODES}')
+
+
+def _get_plan_stages(plan: Dict[str, Any]) -> List[str]:
+    stages = []
+    if 'stage' in plan:
+        stages.append(plan['stage'])
+    for key in ['inputStage', 'queryPlan']:
+        if key in plan:
+            stages += _get_plan_stages(plan[key])
+    for sub_plan in plan.get('inputStages', []):
+        stages += _get_plan_stages(sub_plan)
+    return stages
+
+
+def log_query_plan(db_name: str, collection_name: str, query: Dict[str, Any], log_prefix: str = '') -> List[str]:
+    """
+    Explain (queryPlanner verbosity, the query is not executed) the query and log its winning plan stages,
+    with a warning if the plan is a collection scan
+    """
+    explain = mongo_wrapper.client[db_name].command(
+        'explain', {'find': collection_name, 'filter': query}, verbosity='queryPlanner')
+    stages = _get_plan_stages(explain['queryPlanner']['winningPlan'])
+    if 'COLLSCAN' in stages:
+        logger.warning(f'{log_prefix}Query on {db_name}.{collection_name} is a COLLSCAN, '
+                       f'check the indexes of the collection')
+    else:
+        logger.info(f'{log_prefix}Query plan on {db_name}.{collection_name}: {" <- ".join(stages)}')
+    return stages
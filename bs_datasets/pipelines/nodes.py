@@ -0,0 +1,70 @@
+from typing import Any, Dict, List, Optional
+
+from bs_datasets import mongo_wrapper
+from bs_datasets.pipelines.distances import DistanceMatrix
+from bs_datasets.pipelines.docking_stations import DockingStation
+
+
+def get_nodes_zone_index(zones: Dict[str, List[str]]) -> Dict[str, str]:
+    """
+    Reverse index node -> zone. If a node is in more zones, the first zone is kept
+    """
+    zone_index: Dict[str, str] = {}
+    for zone_id, zone_nodes in zones.items():
+        for node in zone_nodes:
+            if node not in zone_index:
+                zone_index[node] = zone_id
+    return zone_index
+
+
+def load_nodes_metadata(
+        db_name: str,
+        node_ids: List[str],
+        projection: Optional[Dict[str, bool]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Docking station documents of the nodes, loaded with a single $in query and keyed by trip_id
+    """
+    if projection is None:
+        projection = {'_id': False, 'distances_ref': False}
+    results = mongo_wrapper.client[db_name][DockingStation.collection_name].find(
+        {'trip_id': {'$in': node_ids}},
+        projection=projection
+    )
+    return {node_data['trip_id']: node_data for node_data in results}
+
+
+def build_nodes_data(
+        db_name: str,
+        node_ids: List[str],
+        zones: Optional[Dict[str, List[str]]] = None
+) -> Dict[str, Any]:
+    """
+    Build the nodes.json structure of the nodes: their docking station data, the distances between them,
+    the mean bikes percentage and, if zones are provided, their zone_id
+    """
+    distance_matrix = DistanceMatrix.load(db_name)
+    nodes_metadata = load_nodes_metadata(db_name, node_ids)
+    zone_index = get_nodes_zone_index(zones) if zones is not None else None
+    nodes_data = {}
+    for node_id in node_ids:
+        if node_id in nodes_data:
+            continue
+        node_data = nodes_metadata[node_id]
+        node_data['distances'] = distance_matrix.sorted_distances(node_id, node_ids)
+        if zone_index is not None:
+            node_data['zone_id'] = zone_index.get(node_id)
+        mean_percentages = []
+        for _, info in node_data['initial_bikes'].items():
+            total = info['total_docks']
+            bikes = info['total_bikes']
+            mean_percentages.append((bikes * 100) / total)
+
+        node_data['bikes_percentage'] = (sum(mean_percentages) / len(mean_percentages)) / 100
+        del node_data['initial_bikes']
+        nodes_data[node_id] = node_data
+
+    return {
+        'ids': node_ids,
+        'nodes': nodes_data
+    }
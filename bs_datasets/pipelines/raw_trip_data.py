@@ -1,14 +1,13 @@
 import os.path
 from glob import glob
-from multiprocessing.pool import ThreadPool
-from typing import List
+from typing import List, Dict, Any
 
-import numpy as np
 import pandas as pd
-from pymongo import ASCENDING
 
 from bs_datasets import logger, mongo_wrapper
 from bs_datasets.data_utils.data_loader import load_csv_rows, get_provider_info, get_all_providers_info
+from bs_datasets.pipelines.executor import get_worker_pool
+from bs_datasets.pipelines.indexes import managed_indexes
 
 raw_trip_data_collection = 'raw_trip_data'
 
@@ -20,37 +19,44 @@ def raw_trip_data_pipeline(
         provider: str,
         source: str,
         parallel: int,
+        executor: str = 'thread',
+        index_mode: str = 'eager',
         **kwargs
 ):
     if provider == 'all':
         providers = get_all_providers_info()
         for p, _ in providers.items():
             raw_trip_data_pipeline_single_provider(
-                p, os.path.join(source, p, 'chunks'), parallel)
+                p, os.path.join(source, p, 'chunks'), parallel, executor, index_mode)
     else:
-        raw_trip_data_pipeline_single_provider(provider, source, parallel)
+        raw_trip_data_pipeline_single_provider(provider, source, parallel, executor, index_mode)
 
 
 def raw_trip_data_pipeline_single_provider(
         provider: str,
         source: str,
         parallel: int,
+        executor: str = 'thread',
+        index_mode: str = 'eager',
 ):
-    logger.info(f'{STAGE_NAME} | Started for provider {provider} with chunk folder {source}')
+    logger.info(f'{STAGE_NAME} | Started for provider {provider} with chunk folder {source}'
+                f' and {parallel} {executor} workers')
+    db_name = f'{mongo_wrapper.db_prefix_name}-{provider}'
     chunk_files = sorted(glob(f'{source}/chunk_*.csv'), key=lambda x: x.split('/')[-1])
     n_files = len(chunk_files)
-    pool = ThreadPool(parallel)
-    for i, chunk_path in enumerate(chunk_files):
-        kwargs = {
-            'provider': provider,
-            'chunk_path': chunk_path,
-            'index': i,
-            'total': n_files
-        }
-        pool.apply_async(
-            _raw_trip_data_single_chunk_pipeline, kwds=kwargs, error_callback=lambda e: logger.exception(e))
-    pool.close()
-    pool.join()
+    with managed_indexes(db_name, raw_trip_data_collection, mode=index_mode):
+        pool = get_worker_pool(executor, parallel)
+        for i, chunk_path in enumerate(chunk_files):
+            kwargs = {
+                'provider': provider,
+                'chunk_path': chunk_path,
+                'index': i,
+                'total': n_files
+            }
+            pool.apply_async(
+                _raw_trip_data_single_chunk_pipeline, kwds=kwargs, error_callback=lambda e: logger.exception(e))
+        pool.close()
+        pool.join()
     logger.info(f'{STAGE_NAME} | Completed')
 
 
@@ -68,25 +74,21 @@ def _raw_trip_data_single_chunk_pipeline(
     year = filename.split('_')[1][:4]
     csv_head_mapping = provider_info['csv_head_mapping'][year]
     df: pd.DataFrame = load_csv_rows(chunk_path)
-    df = df.replace({np.nan: None})
-    data = []
-    fields_to_keep = [field_name for _, field_name in csv_head_mapping.items()]
-    create_raw_trip_data_indexes(db_name, list(csv_head_mapping.keys()) + ['duration'])
-    fields_to_keep_mapping = {field_name: global_key for global_key, field_name in csv_head_mapping.items()}
-    for _, row in df.iterrows():
-        row_data = {
-            fields_to_keep_mapping[key]: val
-            for key, val in row.items() if key in fields_to_keep and fields_to_keep_mapping[key] != 'extra_column'
-        }
-        duration = row_data['stop_time'] - row_data['start_time']
-        row_data['duration'] = duration.seconds
-        if row_data['stop_time'] > row_data['start_time']:
-            data.append(row_data)
-    mongo_wrapper.client[db_name][collection_name].insert_many(data)
+    data = raw_trip_records(df, csv_head_mapping)
+    with mongo_wrapper.bulk_writer(collection_name, db_name, log_prefix=f'{STAGE_NAME} | ') as writer:
+        writer.extend(data)
     logger.info(f'{STAGE_NAME} | completed processing for chunk {index}/{total}')
 
 
-def create_raw_trip_data_indexes(db_name, fields: List[str]):
-    collection_name = f'{raw_trip_data_collection}'
-    indexes = [(field, ASCENDING) for field in fields if field != 'extra_column']
-    mongo_wrapper.client[db_name][collection_name].create_index(indexes, background=True)
+def raw_trip_records(df: pd.DataFrame, csv_head_mapping: Dict[str, str]) -> List[Dict[str, Any]]:
+    fields_to_keep_mapping = {
+        field_name: global_key for global_key, field_name in csv_head_mapping.items() if global_key != 'extra_column'
+    }
+    df = df[[field_name for field_name in df.columns if field_name in fields_to_keep_mapping]]
+    df = df.rename(columns=fields_to_keep_mapping)
+    # keeps the Timedelta.seconds semantic (seconds component of the difference, not the total seconds)
+    df['duration'] = (df['stop_time'] - df['start_time']).dt.seconds
+    df = df[df['stop_time'] > df['start_time']]
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict('records')
+
@@ -1,7 +1,7 @@
 import os
 from glob import glob
 
-from bs_datasets.data_utils.data_loader import load_csv_header, count_file_rows, load_csv_rows, get_all_providers_info
+from bs_datasets.data_utils.data_loader import load_csv_header, load_csv_chunks, get_all_providers_info
 from bs_datasets.logger import logger
 
 BASE_FOLDER = 'data/post-processing'
@@ -47,22 +47,14 @@ def split_csv_into_chunks(source: str, output: str, n_rows: int):
         if not os.path.exists(base_folder):
             os.makedirs(base_folder)
         columns = load_csv_header(source)
-        total_rows = count_file_rows(source) - 1
-        logger.debug(f'CSV rows: {total_rows}')
-        if total_rows % n_rows == 0:
-            chunks = total_rows // n_rows
-        else:
-            chunks = (total_rows // n_rows) + 1
-        logger.debug(f'Chunks: {chunks}')
-        loaded_rows = 1
-        for i in range(chunks):
-            df = load_csv_rows(source, n_rows=n_rows, skiprows=loaded_rows, names=columns)
-            if len(df) > 1:
-                df.to_csv(os.path.join(base_folder, f'chunk_{source_year}-{i}.csv'), index=False)
-                logger.debug(f'Processed chunk {i+1}/{chunks}')
-            loaded_rows += n_rows
+        # single pass over the source file, every chunk is written as soon as it is read
+        total_rows = 0
+        chunks = 0
+        for i, df in enumerate(load_csv_chunks(source, n_rows=n_rows, names=columns)):
+            total_rows += len(df)
+            df.to_csv(os.path.join(base_folder, f'chunk_{source_year}-{i}.csv'), index=False)
+            chunks += 1
+            logger.debug(f'Processed chunk {i+1}')
+        logger.debug(f'CSV rows: {total_rows} - Chunks: {chunks}')
     else:
         raise AttributeError(f'csv file path not exists at "{source}"')
-
-
-
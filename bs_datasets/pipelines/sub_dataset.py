@@ -1,12 +1,23 @@
+import copy
+import heapq
 import json
 import os
 from datetime import datetime, timedelta
-from typing import List, Optional, Any, Dict, Tuple
+from itertools import groupby
+from typing import List, Optional, Any, Dict, Tuple, Iterator, Set, Union
+
+from pymongo import ASCENDING
+from pymongo.cursor import Cursor
 
 from bs_datasets import logger, mongo_wrapper
+from bs_datasets.data_utils.columnar import ColumnarDatasetWriter, SUB_DATASET_FEATURES, check_output_format
 from bs_datasets.data_utils.data_loader import get_all_providers_info, get_provider_info
 from bs_datasets.filesystem import create_directory
+from bs_datasets.pipelines.distances import DistanceMatrix
 from bs_datasets.pipelines.docking_stations import DockingStation
+from bs_datasets.pipelines.weather_data import get_dates_weather
+from bs_datasets.pipelines.indexes import create_collection_indexes, log_query_plan
+from bs_datasets.pipelines.nodes import build_nodes_data
 from bs_datasets.pipelines.raw_trip_data import raw_trip_data_collection
 
 STAGE_NAME = 'Sub dataset stage'
@@ -18,6 +29,14 @@ TIME_UNITS_MAPPING = {
     'day': 86400
 }
 
+# "grouped" groups the trips per bin on mongo, "stream" reads the trips sorted by start_time and bins them here
+TRIPS_MODES = ['grouped', 'stream']
+
+DEFAULT_TRIPS_BATCH_SIZE = 5000
+
+# default reference date used by $dateTrunc for aligning the bins
+DATE_TRUNC_REFERENCE = datetime(2000, 1, 1)
+
 
 def multiple_sub_datasets(
         pivot: str,
@@ -35,7 +54,10 @@ def multiple_sub_datasets(
         weather_collection: str = 'observations',
         return_and_not_save: bool = False,
         nodes_from_zones: bool = True,
-        zones_path: str = 'data/zones/ny/zones.json'
+        zones_path: str = 'data/zones/ny/zones.json',
+        trips_mode: str = 'grouped',
+        trips_batch_size: int = DEFAULT_TRIPS_BATCH_SIZE,
+        output_format: str = 'json'
 ):
     n_values = n.split(',')
     if provider == 'all':
@@ -48,28 +70,28 @@ def multiple_sub_datasets(
 
     results = {}
     for p in providers:
-        if p not in results:
-            results[p] = {}
-        for n_val in n_values:
-            res = filter_nodes_from_dataset(
-                pivot,
-                int(n_val) if not nodes_from_zones else n_val,
-                os.path.join(output, p),
-                p,
-                aggregation_unit,
-                aggregation_size,
-                min_date,
-                max_date,
-                name_suffix,
-                min_trip_duration,
-                add_weather_data,
-                weather_db,
-                weather_collection,
-                return_and_not_save,
-                nodes_from_zones,
-                zones_path
-            )
-            results[p][n_val] = res
+        # all the n values of a provider are built from a single scan of the trips
+        results[p] = filter_nodes_from_dataset_targets(
+            pivot,
+            n_values,
+            os.path.join(output, p),
+            p,
+            aggregation_unit,
+            aggregation_size,
+            min_date,
+            max_date,
+            name_suffix,
+            min_trip_duration,
+            add_weather_data,
+            weather_db,
+            weather_collection,
+            return_and_not_save,
+            nodes_from_zones,
+            zones_path,
+            trips_mode,
+            trips_batch_size,
+            output_format
+        )
     if return_and_not_save:
         return results
 
@@ -90,87 +112,173 @@ def filter_nodes_from_dataset(
         weather_collection: str = 'observations',
         return_and_not_save: bool = False,
         nodes_from_zones: bool = True,
-        zones_path: str = 'data/zones/ny/zones.json'
+        zones_path: str = 'data/zones/ny/zones.json',
+        trips_mode: str = 'grouped',
+        trips_batch_size: int = DEFAULT_TRIPS_BATCH_SIZE,
+        output_format: str = 'json'
 ):
+    return filter_nodes_from_dataset_targets(
+        pivot, [n], output, provider, aggregation_unit, aggregation_size, min_date, max_date, name_suffix,
+        min_trip_duration, add_weather_data, weather_db, weather_collection, return_and_not_save,
+        nodes_from_zones, zones_path, trips_mode, trips_batch_size, output_format
+    )[n]
+
+
+def filter_nodes_from_dataset_targets(
+        pivot: str,
+        n_values: List[Union[int, str]],
+        output: str,
+        provider: str,
+        aggregation_unit: str,
+        aggregation_size: int,
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        name_suffix: Optional[str] = None,
+        min_trip_duration: int = 60,
+        add_weather_data: bool = False,
+        weather_db: Optional[str] = None,
+        weather_collection: str = 'observations',
+        return_and_not_save: bool = False,
+        nodes_from_zones: bool = True,
+        zones_path: str = 'data/zones/ny/zones.json',
+        trips_mode: str = 'grouped',
+        trips_batch_size: int = DEFAULT_TRIPS_BATCH_SIZE,
+        output_format: str = 'json'
+) -> Dict[Union[int, str], Optional[Tuple[Dict[int, Dict[str, Any]], Dict[str, Any]]]]:
+    """
+    Build the sub datasets of all the n values with a single scan of the trips of the union of their nodes.
+    The trips of every bin are dispatched to the targets having both the start and the stop station.
+    With the "columnar" (or "both") output format the intervals are streamed to the binary files of each target
+    while they are processed
+    """
+    check_output_format(output_format)
+    n_values = list(dict.fromkeys(n_values))
+    # the results are keyed by the given n values, the nodes are selected by number unless they come from zones
+    targets_n: Dict[Union[int, str], Union[int, str]] = {
+        n: int(n) if not nodes_from_zones else n for n in n_values
+    }
     db_name = f'{mongo_wrapper.db_prefix_name}-{provider}'
     provider_info = get_provider_info(provider)
-    node_ids = get_nodes_id(pivot, n, provider_info, db_name, nodes_from_zones, zones_path)
-    aggregated_data = filter_sub_dataset_query(
-        db_name, raw_trip_data_collection, node_ids, aggregation_unit,
-        aggregation_size, min_date, max_date, min_trip_duration)
+    targets_node_ids: Dict[Union[int, str], List[str]] = {
+        n: get_nodes_id(pivot, targets_n[n], provider_info, db_name, nodes_from_zones, zones_path) for n in n_values
+    }
+    all_node_ids: List[str] = list(dict.fromkeys(
+        node_id for node_ids in targets_node_ids.values() for node_id in node_ids))
+    logger.info(f'{STAGE_NAME} | Building {len(n_values)} sub datasets for provider {provider} '
+                f'from the trips of {len(all_node_ids)} nodes')
+    trip_bins = get_trip_bins(
+        trips_mode, db_name, raw_trip_data_collection, all_node_ids, aggregation_unit,
+        aggregation_size, min_date, max_date, min_trip_duration, trips_batch_size)
 
     dataset, initial_date, end_date = init_empty_dataset(
         aggregation_size=aggregation_size * TIME_UNITS_MAPPING[aggregation_unit],
         min_date=min_date, max_date=max_date,
         add_weather_data=add_weather_data, weather_db=weather_db, weather_collection=weather_collection
     )
-    all_out_interval_trips = []
+    datasets = {n: copy.deepcopy(dataset) for n in n_values}
+    # None if the target has all the nodes, so its trips do not need to be filtered
+    targets_node_sets: Dict[Union[int, str], Optional[Set[str]]] = {
+        n: set(node_ids) if len(set(node_ids)) < len(all_node_ids) else None
+        for n, node_ids in targets_node_ids.items()
+    }
+    max_duration = TIME_UNITS_MAPPING[aggregation_unit] * aggregation_size
+    sweeps = {n: IntervalTripsSweep(max_duration) for n in n_values}
+    save_json = return_and_not_save or output_format != 'columnar'
+    writers: Dict[Union[int, str], ColumnarDatasetWriter] = {}
+    if not return_and_not_save and output_format != 'json':
+        writers = {
+            n: ColumnarDatasetWriter(
+                get_sub_dataset_output_path(output, targets_n[n], initial_date, end_date, name_suffix),
+                targets_node_ids[n], SUB_DATASET_FEATURES, initial_date, max_duration, len(dataset), with_od=True
+            ) for n in n_values
+        }
+    current_bin = next(trip_bins, None)
 
     for date_interval_str, _ in dataset.items():
         date_interval = datetime.fromisoformat(date_interval_str)
-        stations = {}
-        max_duration = TIME_UNITS_MAPPING[aggregation_unit] * aggregation_size
-        in_interval_trips = []
-        out_interval_trips = []
-        if date_interval in aggregated_data:
-            interval_data = aggregated_data[date_interval]
-            for i, trip in enumerate(interval_data['trips']):
-                end_trip_id = trip['stop_trip_id']
-                if trip['stop_time'] > date_interval + timedelta(seconds=max_duration):
-                    out_interval_trips.append(trip)
-                    all_out_interval_trips.append(trip)
-                else:
-                    in_interval_trips.append(trip)
-                    if end_trip_id not in stations:
-                        stations[end_trip_id] = {
-                            'started': {'in_interval': 0, 'out_interval': 0},
-                            'ended': {}
-                        }
-        # filter the all_out_interval_trips by removing all the previous trips
-        # that ended in the current time interval and consider them as the in_interval_trips
-        previous_interval_trips = find_and_remove_inside_interval_trips(
-            all_out_interval_trips, date_interval, max_duration)
-        if len(previous_interval_trips) > 0:
-            for trip in previous_interval_trips:
-                stop_trip_id = trip['stop_trip_id']
-                if stop_trip_id not in stations:
-                    stations[stop_trip_id] = {
-                        'started': {'in_interval': 0, 'out_interval': 0},
-                        'ended': {}
-                    }
-            in_interval_trips += previous_interval_trips
-
-        if len(out_interval_trips) > 0:
-            for trip in out_interval_trips:
-                start_id = trip['start_trip_id']
-                if start_id in stations:
-                    stations[start_id]['started']['out_interval'] += 1
-                else:
-                    stations[start_id] = {
-                        'started': {'in_interval': 0, 'out_interval': 1},
-                        'ended': {}
-                    }
+        # the bins are sorted, the ones not matching a dataset interval are skipped
+        while current_bin is not None and current_bin[0] < date_interval:
+            current_bin = next(trip_bins, None)
+        interval_trips = []
+        if current_bin is not None and current_bin[0] == date_interval:
+            interval_trips = current_bin[1]
+        for n in n_values:
+            node_set = targets_node_sets[n]
+            target_trips = interval_trips if node_set is None else [
+                trip for trip in interval_trips
+                if trip['start_trip_id'] in node_set and trip['stop_trip_id'] in node_set
+            ]
+            stations = sweeps[n].process_interval(date_interval, target_trips)
+            interval_data = datasets[n][date_interval.isoformat()]
+            if n in writers:
+                writers[n].write_interval(interval_data['index'], *get_columnar_interval(stations))
+            if save_json:
+                interval_data['stations'] = stations
+            interval_data['n_stations'] = len(stations)
+
+    for n, writer in writers.items():
+        weather = [val['weather'] for val in datasets[n].values()] if add_weather_data else None
+        writer.close(end_date, weather)
+        logger.info(f'{STAGE_NAME} | Saved the columnar dataset of {targets_n[n]} nodes in {writer.path}')
 
-        for station_id, station_data in stations.items():
-            station_data['started']['out_interval'] = len(
-                [out_trip for out_trip in out_interval_trips if out_trip['start_trip_id'] == station_id])
-            in_interval_count = 0
-
-            for in_trip in in_interval_trips:
-                start_trip_id = in_trip['start_trip_id']
-                if in_trip['stop_trip_id'] == station_id:
-                    in_interval_count += 1
-                    if start_trip_id not in station_data['ended']:
-                        station_data['ended'][start_trip_id] = {
-                            'trip_start_station_id': start_trip_id,
-                            'n_bikes': 1
-                        }
-                    else:
-                        station_data['ended'][start_trip_id]['n_bikes'] += 1
-            station_data['started']['in_interval'] = in_interval_count
+    return {
+        n: save_sub_dataset(
+            datasets[n], targets_node_ids[n], pivot, targets_n[n], output, provider, initial_date, end_date,
+            name_suffix, add_weather_data, weather_db, weather_collection, return_and_not_save,
+            nodes_from_zones, zones_path, output_format
+        ) for n in n_values
+    }
 
-        dataset[date_interval.isoformat()]['stations'] = stations
-        dataset[date_interval.isoformat()]['n_stations'] = len(stations)
+
+def get_sub_dataset_output_path(
+        output: str,
+        n: Union[int, str],
+        initial_date: datetime,
+        end_date: datetime,
+        name_suffix: Optional[str] = None
+) -> str:
+    if name_suffix is None:
+        return os.path.join(output, f'{n}_nodes-s={initial_date.isoformat()}-e={end_date.isoformat()}')
+    return os.path.join(output, f'{n}_nodes-{name_suffix}')
+
+
+def get_columnar_interval(
+        stations: Dict[str, Dict[str, Any]]
+) -> Tuple[Dict[str, List[int]], List[Tuple[str, str, int]]]:
+    """
+    Values (started_in, started_out, ended) of the interval stations and their (origin, destination, n_bikes)
+    entries, as written by the ColumnarDatasetWriter
+    """
+    values = {}
+    od = []
+    for station_id, station_data in stations.items():
+        ended = 0
+        for origin_id, ended_data in station_data['ended'].items():
+            ended += ended_data['n_bikes']
+            od.append((origin_id, station_id, ended_data['n_bikes']))
+        values[station_id] = [station_data['started']['in_interval'], station_data['started']['out_interval'], ended]
+    return values, od
+
+
+def save_sub_dataset(
+        dataset: Dict[str, Dict[str, Any]],
+        node_ids: List[str],
+        pivot: str,
+        n: Union[int, str],
+        output: str,
+        provider: str,
+        initial_date: datetime,
+        end_date: datetime,
+        name_suffix: Optional[str] = None,
+        add_weather_data: bool = False,
+        weather_db: Optional[str] = None,
+        weather_collection: str = 'observations',
+        return_and_not_save: bool = False,
+        nodes_from_zones: bool = True,
+        zones_path: str = 'data/zones/ny/zones.json',
+        output_format: str = 'json'
+):
+    db_name = f'{mongo_wrapper.db_prefix_name}-{provider}'
 
     # change index
     final_dataset = {}
@@ -183,42 +291,15 @@ def filter_nodes_from_dataset(
     # get filtered zones
     filtered_zones = get_zones_filtered(pivot, zones_path)
     # build nodes data
-    nodes_data = {}
-    for node_id in node_ids:
-        node_data = mongo_wrapper.client[db_name][DockingStation.collection_name].find_one(
-            {'trip_id': node_id},
-            projection={'_id': False}
-        )
-        distances = {}
-        for n_id, distance in node_data['distances'].items():
-            if n_id in node_ids:
-                distances[n_id] = distance
-        node_data['zone_id'] = get_node_zone(node_id, filtered_zones)
-        node_data['distances'] = distances
-        mean_percentages = []
-        for _, info in node_data['initial_bikes'].items():
-            total = info['total_docks']
-            bikes = info['total_bikes']
-            mean_percentages.append((bikes * 100) / total)
-
-        node_data['bikes_percentage'] = (sum(mean_percentages) / len(mean_percentages)) / 100
-        del node_data['initial_bikes']
-        nodes_data[node_id] = node_data
-
-    nodes_data = {
-        'ids': node_ids,
-        'nodes': nodes_data
-    }
+    nodes_data = build_nodes_data(db_name, node_ids, zones=filtered_zones)
 
-    if name_suffix is None:
-        output = os.path.join(output, f'{n}_nodes-s={initial_date.isoformat()}-e={end_date.isoformat()}')
-    else:
-        output = os.path.join(output, f'{n}_nodes-{name_suffix}')
+    output = get_sub_dataset_output_path(output, n, initial_date, end_date, name_suffix)
 
     if not return_and_not_save:
         create_directory(output)
-        with open(os.path.join(output, 'dataset.json'), 'w') as f:
-            json.dump(final_dataset, f, indent=2)
+        if output_format != 'columnar':
+            with open(os.path.join(output, 'dataset.json'), 'w') as f:
+                json.dump(final_dataset, f, indent=2)
         with open(os.path.join(output, 'nodes.geojson'), 'w') as f:
             json.dump(geojson_stations, f, indent=2)
         with open(os.path.join(output, 'nodes.json'), 'w') as f:
@@ -233,13 +314,6 @@ def filter_nodes_from_dataset(
         return final_dataset, nodes_data
 
 
-def get_node_zone(node_id: str, filtered_zones: Dict[str, List[str]]) -> str:
-    for zone_id, zone_nodes in filtered_zones.items():
-        for node in zone_nodes:
-            if node == node_id:
-                return zone_id
-
-
 def get_zones_filtered(
         pivot: str,
         zones_path: str,
@@ -306,23 +380,82 @@ def get_nodes_id(
         if pivot == 'none':
             pivot = provider_info['pivot_node']
         logger.info(f'{STAGE_NAME} | Dataset splitting for {n} nodes starting from {pivot}')
-        pivot_station = mongo_wrapper.client[db_name][DockingStation.collection_name].find_one({'trip_id': pivot})
-        return [n for n in list(pivot_station['distances'].keys())[: n]]
-
+        return DistanceMatrix.load(db_name).nearest_ids(pivot, n)
+
+
+class IntervalTripsSweep:
+    """
+    Sweep over the time intervals of the dataset, in chronological order, assigning the trips to the stations.
+    The trips starting in an interval and ending after its end are kept in a heap keyed by stop_time
+    and are popped as ended trips of the first interval whose end is after their stop_time,
+    so every trip is pushed and popped at most once and the stations are updated per trip
+    """
+
+    def __init__(self, interval_duration: int):
+        self.interval_duration: int = interval_duration
+        # (stop_time, arrival sequence, trip) of the trips still in-flight at the end of the last interval
+        self._in_flight: List[Tuple[datetime, int, Dict[str, Any]]] = []
+        self._sequence: int = 0
+
+    @staticmethod
+    def _empty_station() -> Dict[str, Any]:
+        return {
+            'started': {'in_interval': 0, 'out_interval': 0},
+            'ended': {}
+        }
 
-def find_and_remove_inside_interval_trips(
-        trips: List[Dict[str, Any]],
-        date_interval: datetime,
-        interval_duration: int
-) -> List[Dict[str, Any]]:
-    inside_interval_trips: List[Dict[str, Any]] = []
-    max_date = date_interval + timedelta(seconds=interval_duration)
-    for i in reversed(range(len(trips))):
-        trip = trips[i]
-        if trip['stop_time'] < max_date:
-            inside_interval_trips.append(trip)
-            del trips[i]
-    return inside_interval_trips
+    def _pop_ended_trips(self, max_date: datetime) -> List[Dict[str, Any]]:
+        ended: List[Tuple[int, Dict[str, Any]]] = []
+        while len(self._in_flight) > 0 and self._in_flight[0][0] < max_date:
+            _, sequence, trip = heapq.heappop(self._in_flight)
+            ended.append((sequence, trip))
+        # latest started trips first, as they were collected from the end of the in-flight list
+        ended.sort(key=lambda item: item[0], reverse=True)
+        return [trip for _, trip in ended]
+
+    def process_interval(self, date_interval: datetime, trips: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Process the trips started in the interval (sorted by start_time) and return the interval stations
+        """
+        max_date = date_interval + timedelta(seconds=self.interval_duration)
+        stations: Dict[str, Dict[str, Any]] = {}
+        in_interval_trips: List[Dict[str, Any]] = []
+        out_interval_trips: List[Dict[str, Any]] = []
+        for trip in trips:
+            if trip['stop_time'] > max_date:
+                out_interval_trips.append(trip)
+                heapq.heappush(self._in_flight, (trip['stop_time'], self._sequence, trip))
+                self._sequence += 1
+            else:
+                in_interval_trips.append(trip)
+                if trip['stop_trip_id'] not in stations:
+                    stations[trip['stop_trip_id']] = self._empty_station()
+
+        # the previous trips that ended in the current time interval are considered as in_interval_trips
+        previous_interval_trips = self._pop_ended_trips(max_date)
+        for trip in previous_interval_trips:
+            if trip['stop_trip_id'] not in stations:
+                stations[trip['stop_trip_id']] = self._empty_station()
+        in_interval_trips += previous_interval_trips
+
+        for trip in out_interval_trips:
+            start_id = trip['start_trip_id']
+            if start_id not in stations:
+                stations[start_id] = self._empty_station()
+            stations[start_id]['started']['out_interval'] += 1
+
+        for trip in in_interval_trips:
+            start_trip_id = trip['start_trip_id']
+            station_data = stations[trip['stop_trip_id']]
+            station_data['started']['in_interval'] += 1
+            if start_trip_id not in station_data['ended']:
+                station_data['ended'][start_trip_id] = {
+                    'trip_start_station_id': start_trip_id,
+                    'n_bikes': 1
+                }
+            else:
+                station_data['ended'][start_trip_id]['n_bikes'] += 1
+        return stations
 
 
 def init_empty_dataset(
@@ -344,42 +477,122 @@ def init_empty_dataset(
 
     initial_date = current_date
 
-    index = 0
-    last_weather = None
-    none_counter = 0
-    last_hour = None
+    dates: List[datetime] = []
     while current_date < end_date:
-        weather_data = {}
-        if add_weather_data:
-            weather_date_str = current_date.strftime('%Y-%m-%d %H')
-            if current_date.hour != last_hour or last_hour is None:
-                fetched = mongo_wrapper.client[weather_db][weather_collection].find_one({'time_str': weather_date_str})
-                if fetched is None:
-                    fetched = last_weather
-                    none_counter += 1
-                else:
-                    none_counter = 0
-            else:
-                fetched = last_weather
-            weather_data['condition'] = fetched['condition']
-            weather_data['temperature'] = fetched['temperature']
-            weather_data['wind_speed'] = fetched['wind_speed']
-            last_weather = fetched
-            last_hour = current_date.hour
-            if none_counter > 2:
-                logger.warn(f'Weather for {weather_date_str} None in the last {none_counter} step')
-        dataset[current_date.isoformat()] = {
+        dates.append(current_date)
+        current_date += timedelta(seconds=aggregation_size)
+    dates_weather: List[Dict[str, Any]] = [{} for _ in dates]
+    if add_weather_data:
+        dates_weather = get_dates_weather(dates, weather_db, weather_collection)
+    for index, (date, weather_data) in enumerate(zip(dates, dates_weather)):
+        dataset[date.isoformat()] = {
             'index': index,
-            'date': current_date.isoformat(),
+            'date': date.isoformat(),
             'n_stations': 0,
             'weather': weather_data,
             'stations': {}
         }
-        index += 1
-        current_date += timedelta(seconds=aggregation_size)
     return dataset, initial_date, end_date
 
 
+def build_sub_dataset_match(
+        node_ids: List[str],
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        min_trip_duration: int = 60,
+) -> Dict[str, Any]:
+    """
+    Match on the raw trips using plain field operators (no $expr), so the start_time/start_trip_id index is used
+    """
+    match_query: Dict[str, Any] = {
+        'start_trip_id': {'$in': node_ids},
+        'stop_trip_id': {'$in': node_ids},
+        'duration': {'$gte': min_trip_duration},
+    }
+    if min_date is not None or max_date is not None:
+        assert min_date is not None and max_date is not None, \
+            'min_date and max_date must be both defined if one is defined'
+        match_query['start_time'] = {'$gte': datetime.fromisoformat(min_date)}
+        match_query['stop_time'] = {'$lt': datetime.fromisoformat(max_date)}
+    return match_query
+
+
+def prepare_sub_dataset_match(
+        db_name: str,
+        collection_name: str,
+        node_ids: List[str],
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        min_trip_duration: int = 60,
+) -> Dict[str, Any]:
+    match_query = build_sub_dataset_match(node_ids, min_date, max_date, min_trip_duration)
+    # no-op if the raw stage already built them, needed for the collections loaded before the index was registered
+    create_collection_indexes(db_name, collection_name, raw_trip_data_collection)
+    log_query_plan(db_name, collection_name, match_query, log_prefix=f'{STAGE_NAME} | ')
+    return match_query
+
+
+def get_trip_bins(
+        trips_mode: str,
+        db_name: str,
+        collection_name: str,
+        node_ids: List[str],
+        aggregation_unit: str,
+        aggregation_size: int,
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        min_trip_duration: int = 60,
+        batch_size: int = DEFAULT_TRIPS_BATCH_SIZE,
+) -> Iterator[Tuple[datetime, List[Dict[str, Any]]]]:
+    """
+    Iterator over the (bin start date, trips sorted by start_time) pairs, sorted by bin start date
+    """
+    if trips_mode == 'grouped':
+        aggregated_data = filter_sub_dataset_query(
+            db_name, collection_name, node_ids, aggregation_unit,
+            aggregation_size, min_date, max_date, min_trip_duration)
+        return ((bin_date, row['trips']) for bin_date, row in sorted(aggregated_data.items()))
+    elif trips_mode == 'stream':
+        trips = stream_sub_dataset_trips(
+            db_name, collection_name, node_ids, min_date, max_date, min_trip_duration, batch_size)
+        bin_size = timedelta(seconds=aggregation_size * TIME_UNITS_MAPPING[aggregation_unit])
+        return ((bin_date, list(bin_trips)) for bin_date, bin_trips in
+                groupby(trips, key=lambda trip: date_trunc(trip['start_time'], bin_size)))
+    else:
+        raise AttributeError(f'Trips mode "{trips_mode}" not available. Use one of {TRIPS_MODES}')
+
+
+def date_trunc(date: datetime, bin_size: timedelta) -> datetime:
+    """
+    Client-side equivalent of $dateTrunc for the units in TIME_UNITS_MAPPING
+    """
+    return DATE_TRUNC_REFERENCE + ((date - DATE_TRUNC_REFERENCE) // bin_size) * bin_size
+
+
+def stream_sub_dataset_trips(
+        db_name: str,
+        collection_name: str,
+        node_ids: List[str],
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        min_trip_duration: int = 60,
+        batch_size: int = DEFAULT_TRIPS_BATCH_SIZE,
+) -> Cursor:
+    """
+    Flat trips sorted by start_time, without grouping them per bin on mongo, so no bin document
+    can hit the 16MB BSON limit and only the current cursor batch is kept in memory
+    """
+    match_query = prepare_sub_dataset_match(db_name, collection_name, node_ids, min_date, max_date, min_trip_duration)
+    return mongo_wrapper.client[db_name][collection_name].find(match_query, {
+        '_id': False,
+        'start_time': True,
+        'start_trip_id': True,
+        'stop_time': True,
+        'stop_trip_id': True,
+        'duration': True
+    }, batch_size=batch_size, allow_disk_use=True).sort('start_time', ASCENDING)
+
+
 def filter_sub_dataset_query(
         db_name: str,
         collection_name: str,
@@ -390,51 +603,11 @@ def filter_sub_dataset_query(
         max_date: Optional[str] = None,
         min_trip_duration: int = 60,
 ) -> Dict[datetime, Dict[str, Any]]:
-    match_stage_conditions = [
-        {
-            '$expr': {
-                '$in': [
-                    '$start_trip_id', node_ids
-                ]
-            }
-        }, {
-            '$expr': {
-                '$in': [
-                    '$stop_trip_id', node_ids
-                ]
-            }
-        }, {
-            '$expr': {
-                '$gte': [
-                    '$duration', min_trip_duration
-                ]
-            }
-        }
-    ]
-    if min_date is not None or max_date is not None:
-        assert min_date is not None and max_date is not None, \
-            'min_date and max_date must be both defined if one is defined'
-
-        match_stage_conditions.append({
-            '$expr': {
-                '$gte': [
-                    '$start_time', datetime.fromisoformat(min_date)
-                ]
-            }
-        })
-        match_stage_conditions.append({
-            '$expr': {
-                '$lt': [
-                    '$stop_time', datetime.fromisoformat(max_date)
-                ]
-            }
-        })
+    match_query = prepare_sub_dataset_match(db_name, collection_name, node_ids, min_date, max_date, min_trip_duration)
     options = {'allowDiskUse': True}
     pipeline = [
         {
-            '$match': {
-                '$and': match_stage_conditions
-            }
+            '$match': match_query
         }, {
             '$sort': {
                 'start_time': 1
@@ -489,7 +662,7 @@ def get_unique_stations(node_ids: List[str], provider: str) -> List[Dict[str, An
         {'trip_id': {'$in': node_ids}},
         projection={
             '_id': False,
-            'distances': False,
+            'distances_ref': False,
             'initial_bikes': False
         }
     ))
@@ -1,19 +1,32 @@
 import os.path
+import threading
 from glob import glob
-from multiprocessing.pool import ThreadPool
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterator, Optional, Sequence, Tuple
 
 import pandas as pd
-from pymongo import ASCENDING
+from pymongo import DeleteMany, UpdateOne
+from pymongo.errors import OperationFailure
 
 from bs_datasets import logger, mongo_wrapper
 from bs_datasets.data_utils.data_loader import load_csv_rows, get_provider_info, get_all_providers_info
+from bs_datasets.pipelines.executor import get_worker_pool
+from bs_datasets.pipelines.indexes import create_collection_indexes, managed_indexes
 
 trip_data_collection = 'trip_data'
 
 
 STAGE_NAME = 'Trip data stage'
 
+MERGE_MODES = ['server', 'client']
+
+# operations per bulk_write and ids per DeleteMany of the client side duplicates merge
+MERGE_OPERATIONS_BATCH_SIZE = 10000
+MERGE_DELETE_BATCH_SIZE = 20000
+
+# chunk counts buffered by the aggregator before merging them into the totals
+DEFAULT_MERGE_EVERY = 8
+DEFAULT_RECORDS_BATCH_SIZE = 100000
+
 
 def trip_data_pipeline(
         provider: str,
@@ -21,15 +34,20 @@ def trip_data_pipeline(
         year: int,
         parallel: int,
         clean_only: bool = False,
-        aggregation_frequency: str = '4h'
+        aggregation_frequency: str = '4h',
+        executor: str = 'thread',
+        index_mode: str = 'eager',
+        merge_mode: str = 'server'
 ):
     if provider == 'all':
         providers = get_all_providers_info()
         for p, _ in providers.items():
             trip_data_pipeline_single_provider(
-                p, os.path.join(source, p, 'chunks'), year, parallel, clean_only, aggregation_frequency)
+                p, os.path.join(source, p, 'chunks'), year, parallel, clean_only, aggregation_frequency, executor,
+                index_mode, merge_mode)
     else:
-        trip_data_pipeline_single_provider(provider, source, year, parallel, clean_only, aggregation_frequency)
+        trip_data_pipeline_single_provider(
+            provider, source, year, parallel, clean_only, aggregation_frequency, executor, index_mode, merge_mode)
 
 
 def trip_data_pipeline_single_provider(
@@ -38,13 +56,22 @@ def trip_data_pipeline_single_provider(
         year: int,
         parallel: int,
         clean_only: bool = False,
-        aggregation_frequency: str = '4h'
+        aggregation_frequency: str = '4h',
+        executor: str = 'thread',
+        index_mode: str = 'eager',
+        merge_mode: str = 'server'
 ):
     logger.info(f'{STAGE_NAME} | Started for provider {provider} with chunk folder {source}')
-    if not clean_only:
+    db_name = f'{mongo_wrapper.db_prefix_name}-{provider}'
+    collection_name = f'{trip_data_collection}-{year}'
+    if clean_only:
+        logger.info(f'{STAGE_NAME} | Merging duplicates')
+        clean_duplicates(provider, year, merge_mode)
+    else:
         chunk_files = sorted(glob(f'{source}/chunk_*.csv'), key=lambda x: x.split('/')[-1])
         n_files = len(chunk_files)
-        pool = ThreadPool(parallel)
+        aggregator = TripCountsAggregator()
+        pool = get_worker_pool(executor, parallel)
         for i, chunk_path in enumerate(chunk_files):
             kwargs = {
                 'provider': provider,
@@ -55,11 +82,16 @@ def trip_data_pipeline_single_provider(
                 'total': n_files
             }
             pool.apply_async(
-                _trip_data_single_chunk_pipeline, kwds=kwargs, error_callback=lambda e: logger.exception(e))
+                _trip_data_single_chunk_pipeline, kwds=kwargs, callback=aggregator.add,
+                error_callback=lambda e: logger.exception(e))
         pool.close()
         pool.join()
-    logger.info(f'{STAGE_NAME} | Merging duplicates')
-    clean_duplicates(provider, year)
+        # every (bin, station) is written once, so there are no duplicates to merge
+        with managed_indexes(db_name, collection_name, trip_data_collection, mode=index_mode):
+            with mongo_wrapper.bulk_writer(collection_name, db_name, log_prefix=f'{STAGE_NAME} | ') as writer:
+                for records in aggregator.iter_records():
+                    writer.extend(records)
+        logger.info(f'{STAGE_NAME} | Saved {writer.inserted_docs} aggregated records')
     logger.info(f'{STAGE_NAME} | Completed')
 
 
@@ -70,82 +102,133 @@ def _trip_data_single_chunk_pipeline(
         aggregation_frequency: str,
         index: int,
         total: int
-):
+) -> Tuple[pd.Series, pd.Series]:
     logger.info(f'{STAGE_NAME} | processing chunk {index}/{total}')
-    db_name = f'{mongo_wrapper.db_prefix_name}-{provider}'
-    collection_name = f'{trip_data_collection}-{year}'
-    create_trip_data_indexes(db_name, year)
     provider_info = get_provider_info(provider)
     csv_head_mapping = provider_info['csv_head_mapping'][str(year)]
     df: pd.DataFrame = load_csv_rows(chunk_path)
-    dataset = handle_df(df, year, aggregation_frequency, csv_head_mapping)
-    mongo_wrapper.client[db_name][collection_name].insert_many(dataset)
+    counts = count_trips(df, aggregation_frequency, csv_head_mapping)
     logger.info(f'{STAGE_NAME} | completed processing for chunk {index}/{total}')
+    return counts
+
+
+class TripCountsAggregator:
+    """
+    Running trip counts of a provider across all its chunks, indexed by (bin, station) for the started and the
+    ended trips. A bin split between two chunks is summed here instead of being saved twice.
+    Chunk counts are added from the pool callbacks: they are buffered and merged every `merge_every` chunks,
+    so the totals are not realigned for every chunk
+    """
+
+    def __init__(self, merge_every: int = DEFAULT_MERGE_EVERY):
+        self.merge_every: int = merge_every
+        self.start_counts: Optional[pd.Series] = None
+        self.end_counts: Optional[pd.Series] = None
+        self._pending: List[Tuple[pd.Series, pd.Series]] = []
+        self._lock = threading.Lock()
+
+    def add(self, counts: Tuple[pd.Series, pd.Series]):
+        with self._lock:
+            self._pending.append(counts)
+            if len(self._pending) >= self.merge_every:
+                self._merge_pending()
 
+    def _merge_pending(self):
+        if len(self._pending) == 0:
+            return
+        start_counts, end_counts = zip(*self._pending)
+        self.start_counts = _sum_counts(self.start_counts, start_counts)
+        self.end_counts = _sum_counts(self.end_counts, end_counts)
+        self._pending = []
 
-def handle_df(df, year: int, aggregation_frequency: str, csv_head_mapping: Dict[str, str]) -> List[Dict[str, Any]]:
-    grouped_start_data = df.groupby(
+    def iter_records(
+            self,
+            batch_size: int = DEFAULT_RECORDS_BATCH_SIZE
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        trip_data documents of the totals, in batches of `batch_size` records
+        """
+        with self._lock:
+            self._merge_pending()
+        for operation, counts in (('start', self.start_counts), ('end', self.end_counts)):
+            if counts is None:
+                continue
+            for i in range(0, len(counts), batch_size):
+                yield flatten_counts(counts.iloc[i: i + batch_size], operation).to_dict('records')
+
+
+def _sum_counts(total: Optional[pd.Series], counts: Sequence[pd.Series]) -> pd.Series:
+    parts = list(counts) if total is None else [total, *counts]
+    merged = pd.concat(parts)
+    return merged.groupby(level=[0, 1], sort=True).sum()
+
+
+def count_trips(
+        df: pd.DataFrame,
+        aggregation_frequency: str,
+        csv_head_mapping: Dict[str, str]
+) -> Tuple[pd.Series, pd.Series]:
+    """
+    Number of started and ended trips per (bin, station) of the chunk
+    """
+    extra_col = csv_head_mapping['extra_column']
+    start_counts = df.groupby(
         [pd.Grouper(key=csv_head_mapping['start_time'], freq=aggregation_frequency),
          csv_head_mapping['start_trip_id']]
-    ).agg({csv_head_mapping['extra_column']: 'count'})
+    )[extra_col].count()
 
-    grouped_end_data = df.groupby(
+    end_counts = df.groupby(
         [pd.Grouper(key=csv_head_mapping['stop_time'], freq=aggregation_frequency),
          csv_head_mapping['stop_trip_id']]
-    ).agg({csv_head_mapping['extra_column']: 'count'})
+    )[extra_col].count()
+    return start_counts, end_counts
 
-    return flatten_and_merge_groups(grouped_start_data, grouped_end_data, year, csv_head_mapping)
 
+def flatten_counts(counts: pd.Series, operation: str) -> pd.DataFrame:
+    """
+    trip_data documents (one row per (bin, station)) of the counts of an operation
+    """
+    flat = counts.rename('value').rename_axis(['date', 'station']).reset_index()
+    dates = flat['date'].dt
+    return pd.DataFrame({
+        'month': dates.month,
+        'day': dates.day,
+        'weekday': dates.weekday,
+        'hour': dates.hour,
+        'station': flat['station'],
+        'value': flat['value'],
+        'operation': operation,
+        'date': flat['date']
+    })
 
-def create_trip_data_indexes(db_name, year):
-    collection_name = f'{trip_data_collection}-{year}'
-    mongo_wrapper.client[db_name][collection_name].create_index([
-        ('date', ASCENDING),
-        ('operation', ASCENDING),
-        ('station', ASCENDING),
-        ('weekday', ASCENDING),
-        ('value', ASCENDING)
-    ], background=True)
-
-
-def flatten_and_merge_groups(
-        start_df: pd.DataFrame,
-        end_df: pd.DataFrame,
-        year: int,
-        csv_head_mapping: Dict[str, str]
-) -> List[Dict[str, Any]]:
-    data: List[Dict[str, Any]] = []
-    extra_col = csv_head_mapping['extra_column']
-    for (dtime, station), value in start_df.iterrows():
-        data.append({
-            'month': dtime.month,
-            'day': dtime.day,
-            'weekday': dtime.weekday(),
-            'hour': dtime.hour,
-            'station': station,
-            'value': value[extra_col].item(),
-            'operation': 'start',
-            'date': dtime
-        })
-    for (dtime, station), value in end_df.iterrows():
-        data.append({
-            'month': dtime.month,
-            'day': dtime.day,
-            'weekday': dtime.weekday(),
-            'hour': dtime.hour,
-            'station': station,
-            'value': value[extra_col].item(),
-            'operation': 'end',
-            'date': dtime
-        })
-    return data
-
-
-def clean_duplicates(provider: str, year: int):
+
+def clean_duplicates(provider: str, year: int, merge_mode: str = 'server'):
+    """
+    Merge the documents with the same (station, date, operation) summing their value.
+    "server" rebuilds the deduplicated collection with a $group + $out and swaps it in with a rename,
+    "client" (used also as fallback if the server merge fails) streams the duplicated groups and applies
+    the merge with bounded bulk_write batches
+    """
     db_name = f'{mongo_wrapper.db_prefix_name}-{provider}'
     collection_name = f'{trip_data_collection}-{year}'
-    options = {'allowDiskUse': True}
-    duplicates_result = mongo_wrapper.client[db_name][collection_name].aggregate([
+    if merge_mode == 'server':
+        try:
+            duplicates_removed = _server_merge_duplicates(db_name, collection_name)
+        except OperationFailure as e:
+            logger.warning(f'{STAGE_NAME} | Server side merge failed ({e}), merging duplicates client side')
+            duplicates_removed = _client_merge_duplicates(db_name, collection_name)
+    elif merge_mode == 'client':
+        duplicates_removed = _client_merge_duplicates(db_name, collection_name)
+    else:
+        raise AttributeError(f'Merge mode "{merge_mode}" not available. Use one of {MERGE_MODES}')
+    logger.info(f'{STAGE_NAME} | Merged {duplicates_removed} duplicates')
+
+
+def _server_merge_duplicates(db_name: str, collection_name: str) -> int:
+    db = mongo_wrapper.client[db_name]
+    tmp_collection_name = f'{collection_name}-dedup'
+    n_documents = db[collection_name].estimated_document_count()
+    db[collection_name].aggregate([
         {
             '$group': {
                 '_id': {
@@ -153,6 +236,46 @@ def clean_duplicates(provider: str, year: int):
                     'date': '$date',
                     'operation': '$operation'
                 },
+                'doc': {
+                    '$first': '$$ROOT'
+                },
+                'value': {
+                    '$sum': '$value'
+                }
+            }
+        }, {
+            '$replaceRoot': {
+                'newRoot': {
+                    '$mergeObjects': ['$doc', {'value': '$value'}]
+                }
+            }
+        }, {
+            '$out': tmp_collection_name
+        }
+    ], allowDiskUse=True)
+    create_collection_indexes(db_name, tmp_collection_name, trip_data_collection)
+    duplicates_removed = n_documents - db[tmp_collection_name].estimated_document_count()
+    # atomic swap of the deduplicated collection
+    db[tmp_collection_name].rename(collection_name, dropTarget=True)
+    return duplicates_removed
+
+
+def _client_merge_duplicates(db_name: str, collection_name: str) -> int:
+    collection = mongo_wrapper.client[db_name][collection_name]
+    duplicates_result = collection.aggregate([
+        {
+            '$group': {
+                '_id': {
+                    'station': '$station',
+                    'date': '$date',
+                    'operation': '$operation'
+                },
+                'ids': {
+                    '$push': '$_id'
+                },
+                'value': {
+                    '$sum': '$value'
+                },
                 'count': {
                     '$sum': 1
                 }
@@ -164,27 +287,22 @@ def clean_duplicates(provider: str, year: int):
                 }
             }
         }
-    ], **options)
-    duplicates_removed = 0
+    ], allowDiskUse=True)
+    operations = []
     ids_to_remove = []
+    duplicates_removed = 0
     for duplicate_info in duplicates_result:
-        duplicates = [r for r in mongo_wrapper.client[db_name][collection_name].find({
-            'station': duplicate_info['_id']['station'],
-            'operation': duplicate_info['_id']['operation'],
-            'date': duplicate_info['_id']['date']
-        })]
-        total_value = duplicates[0]['value']
-        for i in range(1, len(duplicates)):
-            total_value += duplicates[i]['value']
-            ids_to_remove.append(duplicates[i]['_id'])
-        mongo_wrapper.client[db_name][collection_name].find_one_and_update(
-            {'_id': duplicates[0]['_id']}, {'$set': {'value': total_value}})
-        if len(ids_to_remove) >= 5000:
-            removed = mongo_wrapper.client[db_name][collection_name].delete_many({'_id': {'$in': ids_to_remove}})
-            duplicates_removed += removed.deleted_count
+        operations.append(UpdateOne({'_id': duplicate_info['ids'][0]}, {'$set': {'value': duplicate_info['value']}}))
+        ids_to_remove += duplicate_info['ids'][1:]
+        # bounded $in filters, one with millions of ids would exceed the 16MB document limit
+        if len(ids_to_remove) >= MERGE_DELETE_BATCH_SIZE:
+            operations.append(DeleteMany({'_id': {'$in': ids_to_remove}}))
             ids_to_remove = []
-            logger.debug(
-                f'{STAGE_NAME} | Still merging duplicates | Duplicates merged so far {duplicates_removed} ')
-    removed = mongo_wrapper.client[db_name][collection_name].delete_many({'_id': {'$in': ids_to_remove}})
-    duplicates_removed += removed.deleted_count
-    logger.info(f'{STAGE_NAME} | Merged {duplicates_removed} duplicates')
+        if len(operations) >= MERGE_OPERATIONS_BATCH_SIZE:
+            duplicates_removed += collection.bulk_write(operations, ordered=False).deleted_count
+            operations = []
+    if len(ids_to_remove) > 0:
+        operations.append(DeleteMany({'_id': {'$in': ids_to_remove}}))
+    if len(operations) > 0:
+        duplicates_removed += collection.bulk_write(operations, ordered=False).deleted_count
+    return duplicates_removed
@@ -1,13 +1,13 @@
 import os
 from dataclasses import dataclass
 from glob import glob
-from multiprocessing.pool import ThreadPool
 from typing import Tuple
 
 import pandas as pd
 
 from bs_datasets.data_utils.data_loader import load_station_information, load_csv_rows
 from bs_datasets.logger import logger
+from bs_datasets.pipelines.executor import get_worker_pool
 
 
 MAPPING = {
@@ -27,6 +27,12 @@ class VerificationStats:
     nan_entries: int = 0
     missing_entries: int = 0
 
+    def update(self, other: 'VerificationStats'):
+        self.total_entries += other.total_entries
+        self.empty_entries += other.empty_entries
+        self.nan_entries += other.nan_entries
+        self.missing_entries += other.missing_entries
+
 
 def _verify_field(field, bs_stations, stats: VerificationStats) -> Tuple[bool, bool, bool]:
     is_empty = False
@@ -48,9 +54,10 @@ def verify_station_identifier(
         chunks_folder: str,
         chunk_index: int,
         provider: str,
-        stats: VerificationStats,
         verify_field: str
-):
+) -> VerificationStats:
+    # every chunk counts on its own stats, so that they can be returned from a worker process
+    stats = VerificationStats()
     chunk_path = os.path.join(chunks_folder, f'chunk_{chunk_index}.csv')
     if os.path.exists(chunk_path):
         bs_stations = load_station_information(provider, convert_to_map=True, id_field=verify_field)
@@ -64,24 +71,33 @@ def verify_station_identifier(
             end_field_value = str(row[end_field_name])
             _verify_field(start_field_value, bs_stations, stats)
             _verify_field(end_field_value, bs_stations, stats)
+    return stats
 
 
-def verify_data(source: str, provider: str, verify_field: str = 'station_id', parallel: int = 4):
+def verify_data(
+        source: str,
+        provider: str,
+        verify_field: str = 'station_id',
+        parallel: int = 4,
+        executor: str = 'thread'
+):
     if os.path.exists(source):
         chunk_files = glob(f'{source}/chunk_*.csv')
         stats = VerificationStats()
         results = []
-        pool = ThreadPool(processes=parallel)
+        pool = get_worker_pool(executor, parallel)
         for i in range(len(chunk_files)):
             results.append(pool.apply_async(func=verify_station_identifier, kwds={
                 'chunks_folder': source,
                 'chunk_index': i,
                 'provider': provider,
-                'stats': stats,
                 'verify_field': verify_field
             }))
         for res in results:
-            res.wait()
+            try:
+                stats.update(res.get())
+            except Exception as e:
+                logger.exception(e)
         pool.close()
         pool.join()
         logger.info(f'{STAGE_NAME} | Total entries are {stats.total_entries}')
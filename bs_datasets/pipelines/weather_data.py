@@ -5,9 +5,8 @@ from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import List, Any, Dict
 
-from pymongo import ASCENDING
-
 from bs_datasets import logger, mongo_wrapper
+from bs_datasets.pipelines.indexes import create_collection_indexes
 
 API_MAPPING_FILE = 'data/weather_api.json'
 
@@ -15,6 +14,10 @@ MAX_DAYS_PER_REQUEST = 30
 
 DATE_FORMAT_STR = '%Y-%m-%d'
 DATE_FORMAT_API = '%Y%m%d'
+# format of the time_str field of the observations
+DATE_FORMAT_HOUR = '%Y-%m-%d %H'
+
+WEATHER_INDEXES_KEY = 'weather_observations'
 
 STAGE_NAME = 'Weather data'
 
@@ -53,8 +56,7 @@ def fetch_weather_data(
     start_date = datetime.fromisoformat(start)
     end_date = datetime.fromisoformat(end)
     intervals = get_date_intervals(start_date, end_date)
-    db_fields = list(api_info['fieldsMapping'].values())
-    create_weather_data_indexes(db_name, collection_name, db_fields)
+    create_collection_indexes(db_name, collection_name, WEATHER_INDEXES_KEY)
     for i, time_interval in enumerate(intervals):
         logger.info(f'{STAGE_NAME} | Processing time interval {i+1}/{len(intervals)}: {time_interval.to_log()}')
         fetch_data(time_interval, api_info, db_name, collection_name)
@@ -96,17 +98,74 @@ def fetch_data(interval: TimeInterval, api_info: Dict[str, Any], db_name: str, c
                     if key in time_fields:
                         value_date = datetime.fromtimestamp(value)
                         obs_data[f'{fields_mapping[key]}_utc'] = value_date
-                        obs_data[f'{fields_mapping[key]}_str'] = value_date.astimezone(timezone).strftime('%Y-%m-%d %H')
+                        obs_data[f'{fields_mapping[key]}_str'] = value_date.astimezone(timezone).strftime(DATE_FORMAT_HOUR)
                         obs_data[f'{fields_mapping[key]}_timezone'] = timezone.zone
                     else:
                         obs_data[fields_mapping[key]] = value
             db_data.append(obs_data)
-        mongo_wrapper.client[db_name][collection_name].insert_many(db_data)
+        with mongo_wrapper.bulk_writer(collection_name, db_name, log_prefix=f'{STAGE_NAME} | ') as writer:
+            writer.extend(db_data)
     else:
         logger.error('An error occurred while fetching the data from api source')
         logger.error(data_json['errors'])
 
 
-def create_weather_data_indexes(db_name, collection_name, fields: List[str]):
-    indexes = [(field, ASCENDING) for field in fields if field != 'extra_column']
-    mongo_wrapper.client[db_name][collection_name].create_index(indexes, background=True)
+def load_hourly_weather(
+        weather_db: str,
+        weather_collection: str,
+        min_hour: str,
+        max_hour: str
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Fetch with a single query the observations with time_str in [min_hour, max_hour], keyed by time_str.
+    If an hour has more observations, the first one is kept as a find_one on time_str would do
+    """
+    create_collection_indexes(weather_db, weather_collection, WEATHER_INDEXES_KEY)
+    results = mongo_wrapper.client[weather_db][weather_collection].find({
+        'time_str': {'$gte': min_hour, '$lte': max_hour}
+    }, {'_id': False, 'time_str': True, 'condition': True, 'temperature': True, 'wind_speed': True})
+    weather: Dict[str, Dict[str, Any]] = {}
+    for observation in results:
+        if observation['time_str'] not in weather:
+            weather[observation['time_str']] = observation
+    return weather
+
+
+def get_dates_weather(
+        dates: List[datetime],
+        weather_db: str,
+        weather_collection: str = 'observations'
+) -> List[Dict[str, Any]]:
+    """
+    Weather data of every date. The weather is fetched once per hour change, missing hours are filled
+    with the last available weather
+    """
+    if len(dates) == 0:
+        return []
+    hourly_weather = load_hourly_weather(weather_db, weather_collection,
+                                         dates[0].strftime(DATE_FORMAT_HOUR), dates[-1].strftime(DATE_FORMAT_HOUR))
+    dates_weather: List[Dict[str, Any]] = []
+    last_weather = None
+    none_counter = 0
+    last_hour = None
+    for current_date in dates:
+        weather_date_str = current_date.strftime(DATE_FORMAT_HOUR)
+        if current_date.hour != last_hour or last_hour is None:
+            fetched = hourly_weather.get(weather_date_str)
+            if fetched is None:
+                fetched = last_weather
+                none_counter += 1
+            else:
+                none_counter = 0
+        else:
+            fetched = last_weather
+        dates_weather.append({
+            'condition': fetched['condition'],
+            'temperature': fetched['temperature'],
+            'wind_speed': fetched['wind_speed'],
+        })
+        last_weather = fetched
+        last_hour = current_date.hour
+        if none_counter > 2:
+            logger.warn(f'Weather for {weather_date_str} None in the last {none_counter} step')
+    return dates_weather
@@ -1,18 +1,24 @@
+import hashlib
 import json
 import os
+import pickle
 from typing import Tuple, List, Dict, Union, NewType, Optional
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import haversine
 from haversine import Unit
 from pandas import DataFrame
-from shapely import Point, Polygon
+import shapely
+from shapely import Point, Polygon, STRtree
 from shapely.geometry import shape
-from sklearn.cluster import KMeans
 
 from bs_datasets import mongo_wrapper
 from bs_datasets.filesystem import create_directory
+from bs_datasets.pipelines.clustering import benchmark_clustering, cluster_features, load_zones_centroids
+
+ZIP_CODES_CACHE_PATH = 'data/cache/zip_codes'
 
 ZipCode = NewType('ZipCode', Dict[str, Union[Polygon, Dict[str, Union[str, int, float, bool]]]])
 
@@ -26,9 +32,13 @@ def zones_pipeline(
         zip_codes_geojson_path: str = 'data/ny_map/zip_codes.geojson',
         filter_region: Optional[str] = None,
         show_zones: bool = False,
+        clustering_backend: str = 'legacy',
+        clustering_jobs: Optional[int] = None,
+        warm_start: bool = False,
+        clustering_benchmark: bool = False,
         **kwargs,
 ):
-    docks_df, zip_codes_geo, zip_codes_df, zip_codes_mapping = load_data_structures(
+    docks_df, zip_codes_df, zip_codes_mapping = load_data_structures(
         db_name, docking_station_collection_name, zip_codes_geojson_path
     )
     if filter_region is not None:
@@ -46,18 +56,17 @@ def zones_pipeline(
     for _, row in docks_df.iterrows():
         nodes_features_mapping[(row['lng'], row['lat'])] = row['trip_id']
     nodes_features = docks_df[['lng', 'lat']].to_numpy()
-    km = KMeans(
-        n_clusters=n_zones, init='random',
-        n_init=100, max_iter=30000,
-        tol=1e-18, random_state=0
-    )
-    y_km = km.fit_predict(nodes_features)
-    u_labels = km.labels_
+    init_centroids = load_zones_centroids(os.path.join(output, 'zones.json')) if warm_start else None
+    if clustering_benchmark:
+        benchmark_clustering(nodes_features, n_zones, n_jobs=clustering_jobs, init_centroids=init_centroids)
+        return
+    y_km = cluster_features(nodes_features, n_zones, clustering_backend, clustering_jobs, init_centroids)
 
     zones = {}
     zones_centroid = {}
 
-    for i in u_labels:
+    # zones in order of first appearance of their label
+    for i in dict.fromkeys(y_km.tolist()):
         zone_nodes = nodes_features[y_km == i, :]
         zones[str(i)] = []
         zones_centroid[str(i)] = Polygon(zone_nodes).centroid
@@ -75,18 +84,18 @@ def load_data_structures(
         db_name: str,
         docking_station_collection_name: str,
         zip_codes_geojson_path: str
-) -> Tuple[DataFrame, dict, DataFrame, dict]:
+) -> Tuple[DataFrame, DataFrame, Dict[int, ZipCode]]:
     docking_station_data = list(mongo_wrapper.client[db_name][docking_station_collection_name].find(
         {'capacity': {'$gt': 0}},
         {'_id': 1, 'trip_id': 1, 'name': 1, 'capacity': 1, 'position': 1, 'station_id': 1, 'short_name': 1,
          'region_id': 1, 'legacy_id': 1, 'external_id': 1}
     ))
     docks_df = get_docks_df(docking_station_data)
-    zip_codes_geo, zip_codes_df, zip_codes_mapping = get_zip_codes_data(zip_codes_geojson_path)
+    zip_codes_df, zip_codes_mapping, zip_codes_index = load_zip_codes_data(zip_codes_geojson_path)
 
-    docks_df = get_docks_zip_merged(docks_df, zip_codes_mapping)
+    docks_df = get_docks_zip_merged(docks_df, zip_codes_mapping, zip_codes_index)
 
-    return docks_df, zip_codes_geo, zip_codes_df, zip_codes_mapping
+    return docks_df, zip_codes_df, zip_codes_mapping
 
 
 def get_docks_df(docking_station_data: List[dict]) -> DataFrame:
@@ -106,7 +115,55 @@ def get_docks_df(docking_station_data: List[dict]) -> DataFrame:
     return DataFrame(data=data, columns=columns)
 
 
-def get_zip_codes_data(geojson_path: str) -> Tuple[dict, DataFrame, Dict[int, ZipCode]]:
+def load_zip_codes_data(
+        geojson_path: str,
+        cache_path: Optional[str] = ZIP_CODES_CACHE_PATH
+) -> Tuple[DataFrame, Dict[int, ZipCode], Tuple[List[int], STRtree]]:
+    """
+    Zip codes data and spatial index of the geojson file. The parsed polygons are cached as WKB in `cache_path`
+    (None disables the cache), the cache is valid while the file has the same mtime or the same content hash
+    """
+    if cache_path is None:
+        zip_codes_df, zip_codes_mapping = get_zip_codes_data(geojson_path)
+        return zip_codes_df, zip_codes_mapping, build_zip_codes_index(zip_codes_mapping)
+
+    cache_file = os.path.join(cache_path, f'{os.path.basename(geojson_path)}.pkl')
+    mtime_ns = os.stat(geojson_path).st_mtime_ns
+    cached = None
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+    file_hash = None
+    if cached is not None and cached['mtime_ns'] != mtime_ns:
+        file_hash = get_file_hash(geojson_path)
+        if file_hash != cached['sha256']:
+            cached = None
+    if cached is None:
+        zip_codes_df, zip_codes_mapping = get_zip_codes_data(geojson_path)
+        cached = {
+            'sha256': file_hash if file_hash is not None else get_file_hash(geojson_path),
+            'zip_codes_df': zip_codes_df,
+            'zip_codes_mapping': {zip_id: {**zip_code, 'shape': zip_code['shape'].wkb}
+                                  for zip_id, zip_code in zip_codes_mapping.items()},
+        }
+    else:
+        zip_codes_df = cached['zip_codes_df']
+        zip_codes_mapping = {zip_id: {**zip_code, 'shape': shapely.from_wkb(zip_code['shape'])}
+                             for zip_id, zip_code in cached['zip_codes_mapping'].items()}
+    if cached.get('mtime_ns') != mtime_ns:
+        cached['mtime_ns'] = mtime_ns
+        create_directory(cache_path)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.DEFAULT_PROTOCOL)
+    return zip_codes_df, zip_codes_mapping, build_zip_codes_index(zip_codes_mapping)
+
+
+def get_file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_zip_codes_data(geojson_path: str) -> Tuple[DataFrame, Dict[int, ZipCode]]:
     with open(geojson_path, 'r') as f:
         zip_codes_geo = json.load(f)
 
@@ -128,43 +185,54 @@ def get_zip_codes_data(geojson_path: str) -> Tuple[dict, DataFrame, Dict[int, Zi
 
     zip_codes_df = DataFrame(data=zip_codes_data, columns=zip_codes_columns)
 
-    return zip_codes_geo, zip_codes_df, zip_codes_mapping
-
-
-def get_docks_zip_merged(docks_df, zip_codes_mapping):
+    return zip_codes_df, zip_codes_mapping
+
+
+def build_zip_codes_index(zip_codes_mapping: Dict[int, ZipCode]) -> Tuple[List[int], STRtree]:
+    """
+    Spatial index over the zip code polygons, the tree indexes follow the zip_codes_mapping order
+    """
+    zip_ids = list(zip_codes_mapping.keys())
+    return zip_ids, STRtree([zip_codes_mapping[zip_id]['shape'] for zip_id in zip_ids])
+
+
+def get_docks_zip_ids(
+        docks_df: DataFrame,
+        zip_ids: List[int],
+        tree: STRtree
+) -> List[int]:
+    """
+    Zip code of every dock: the first zip code (in zip_codes_mapping order) whose polygon intersects the dock
+    or, if none does, the nearest one
+    """
+    points = shapely.points(docks_df['lng'].to_numpy(), docks_df['lat'].to_numpy())
+    no_zip = len(zip_ids)
+    tree_indexes = np.full(len(points), no_zip, dtype=np.int64)
+    points_indexes, polygons_indexes = tree.query(points, predicate='intersects')
+    # lowest polygon index per point, as the polygons were checked in order
+    np.minimum.at(tree_indexes, points_indexes, polygons_indexes)
+    missing = np.flatnonzero(tree_indexes == no_zip)
+    if len(missing) > 0:
+        nearest_points, nearest_polygons = tree.query_nearest(points[missing])
+        np.minimum.at(tree_indexes, missing[nearest_points], nearest_polygons)
+    return [zip_ids[i] for i in tree_indexes.tolist()]
+
+
+def get_docks_zip_merged(docks_df, zip_codes_mapping, zip_codes_index: Optional[Tuple[List[int], STRtree]] = None):
     columns = ['trip_id', 'zip_code', 'zip_name', 'zip_state', 'zip_borough']
+    if zip_codes_index is None:
+        zip_codes_index = build_zip_codes_index(zip_codes_mapping)
     data = []
 
-    for index, row in docks_df.iterrows():
-        dock_point = Point(row['lng'], row['lat'])
-        found = False
-        min_distance = None
-        min_id = None
-        for zip_id, zip_info in zip_codes_mapping.items():
-            poligon = zip_info['shape']
-            distance = poligon.distance(dock_point)
-            if min_distance is None or distance < min_distance:
-                min_distance = distance
-                min_id = zip_id
-            if poligon.intersects(dock_point):
-                found = True
-                data.append([
-                    row['trip_id'],
-                    zip_info['properties']['postal_code'],
-                    zip_info['properties']['name'],
-                    zip_info['properties']['state'],
-                    zip_info['properties']['borough']
-                ])
-                break
-        if not found:
-            min_distant_zip_info = zip_codes_mapping[min_id]
-            data.append([
-                row['trip_id'],
-                min_distant_zip_info['properties']['postal_code'],
-                min_distant_zip_info['properties']['name'],
-                min_distant_zip_info['properties']['state'],
-                min_distant_zip_info['properties']['borough']
-            ])
+    for trip_id, zip_id in zip(docks_df['trip_id'].tolist(), get_docks_zip_ids(docks_df, *zip_codes_index)):
+        zip_info = zip_codes_mapping[zip_id]
+        data.append([
+            trip_id,
+            zip_info['properties']['postal_code'],
+            zip_info['properties']['name'],
+            zip_info['properties']['state'],
+            zip_info['properties']['borough']
+        ])
 
     df = pd.DataFrame(data=data, columns=columns)
     return pd.merge(docks_df, df, on='trip_id')
@@ -77,6 +77,16 @@ def parse_args():
     sub_raw_trips_parser.add_argument('-p', '--parallel', type=int, default=4, help='Number of parallel work to use')
     sub_raw_trips_parser.add_argument('-b', '--batch-size', type=int, default=50000,
                                       help='Batch size for file reading and db flushing operations')
+    sub_raw_trips_parser.add_argument('--max-in-flight', type=int, default=None,
+                                      help='Maximum number of chunks waiting in each queue of the cdrc raw ingest '
+                                           'pipeline (reader -> transformer -> writer). Default: 2 * parallel')
+    sub_raw_trips_parser.add_argument('--index-mode', default='eager', choices=['eager', 'deferred'],
+                                      help='"eager" creates the indexes once before loading the data, "deferred" '
+                                           'drops the secondary indexes and builds them once after the load. '
+                                           'Default: "eager"')
+    sub_raw_trips_parser.add_argument('--executor', default='thread', choices=['thread', 'process'],
+                                      help='Pool used for processing the chunks. Use "process" for running the '
+                                           'CPU-bound parsing on multiple cores. Default: "thread"')
 
     # # DATASET COMMAND
     # sub_dataset_parser = action_parser.add_parser('dataset', help='Create the final dataset from the trip data')
@@ -130,6 +140,18 @@ def parse_args():
     sub_subdataset_parser.add_argument('--zones-path',
                                        help='Zones file path',
                                        default='data/zones/ny/zones.json')
+    sub_subdataset_parser.add_argument('--trips-mode', default='grouped', choices=['grouped', 'stream'],
+                                       help='"grouped" groups the trips of each interval on mongoDb, '
+                                            '"stream" reads the trips sorted by start time and groups them while '
+                                            'reading, avoiding the 16MB limit on coarse aggregations. '
+                                            'Default: "grouped"')
+    sub_subdataset_parser.add_argument('--trips-batch-size', type=int, default=5000,
+                                       help='Cursor batch size of the "stream" trips mode. Default: 5000')
+    sub_subdataset_parser.add_argument('--output-format', default='json', choices=['json', 'columnar', 'both'],
+                                       help='"json" saves the intervals in dataset.json, "columnar" saves them as '
+                                            'memory-mappable .npy arrays (values per interval and node plus the '
+                                            'sparse origin-destination entries) with an index.json, '
+                                            '"both" saves both formats. Default: "json"')
 
     # ALL COMMAND
     sub_all_parser = action_parser.add_parser('all',
@@ -150,6 +172,13 @@ def parse_args():
                                      'Default "data/post_processing"')
     sub_all_parser.add_argument('-p', '--parallel', type=int, default=6,
                                 help='Number of parallel work to use for the trips stage. Default 6')
+    sub_all_parser.add_argument('--index-mode', default='eager', choices=['eager', 'deferred'],
+                                help='"eager" creates the indexes of the raw stage once before loading the data, '
+                                     '"deferred" drops the secondary indexes and builds them once after the load. '
+                                     'Default: "eager"')
+    sub_all_parser.add_argument('--executor', default='thread', choices=['thread', 'process'],
+                                help='Pool used for processing the chunks in the raw stage. Use "process" for '
+                                     'running the CPU-bound parsing on multiple cores. Default: "thread"')
     sub_all_parser.add_argument('--dataset-path', default='data/datasets',
                                 help='Path used for saving the final datasets. Default "data/datasets"')
     # sub_all_parser.add_argument('-a', '--aggregation-frequency', default='4h',
@@ -190,6 +219,9 @@ def parse_args():
     sub_all_parser.add_argument('--zones-path',
                                 help='Zones file path',
                                 default='data/zones/ny/zones.json')
+    sub_all_parser.add_argument('--output-format', default='json', choices=['json', 'columnar', 'both'],
+                                help='Format of the datasets of the cdrc subdataset stage: "json", "columnar" '
+                                     'or "both". Default: "json"')
 
     # WEATHER DATA COMMAND
     weather_parser = action_parser.add_parser('weather', help='Start the weather pipeline')
@@ -222,5 +254,17 @@ def parse_args():
                               help='Region id to use as a filter')
     zones_parser.add_argument('--show-zones', action='store_true', default=False,
                               help='Plot the created zones at the end of the pipeline')
+    zones_parser.add_argument('--clustering-backend', default='legacy', choices=['legacy', 'kmeans++', 'minibatch'],
+                              help='"legacy" uses KMeans with 100 random inits and no early stop, "kmeans++" uses '
+                                   'k-means++ seeding with 10 inits and early stop, "minibatch" uses '
+                                   'MiniBatchKMeans. Default: "legacy"')
+    zones_parser.add_argument('--clustering-jobs', type=int, default=None,
+                              help='Number of parallel jobs used for running the KMeans inits. Default: sequential')
+    zones_parser.add_argument('--warm-start', action='store_true', default=False,
+                              help='Start the clustering from the centroids of the existing zones.json '
+                                   'in the output folder')
+    zones_parser.add_argument('--clustering-benchmark', action='store_true', default=False,
+                              help='Compare runtime and assignment quality of the clustering backends '
+                                   'without saving the zones')
 
     return main_parser.parse_args()